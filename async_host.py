@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import socket
+import threading
+import time
+
+import cv2
+
+import di_utils
+import protocol
+from clock import ClockEstimator
+from codec import RawCodec, make_codec
+
+
+class AsyncConnection:
+
+    def __init__(self, reader, writer, codec):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.clock = ClockEstimator()
+        self.ring = None
+
+    def close(self):
+        self.writer.close()
+        if self.ring is not None:
+            self.ring.close()
+
+
+class AsyncHost:
+
+    def __init__(self, port=8080, verbose=False, codec=None, num_connections=None, socket_options=None):
+
+        self.verbose = verbose
+        self.codec = codec if codec else make_codec("jpeg")
+        self.close_new = False
+        self.conns = []
+        self.conn_cond = threading.Condition()
+        self.first_rec_time = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.t = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.t.start()
+
+        self.socket_options = socket_options if socket_options is not None else di_utils.socket_options()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Buffer sizes must be set before listening to take effect on the connections
+        di_utils.apply_socket_options(s, self.socket_options)
+        s.bind(('', port))
+        self.server = self.run(asyncio.start_server(self._add_connection, sock=s))
+
+        if num_connections is None:
+            input("Press enter to stop accepting connections and begin transmission\n")
+        else:
+            with self.conn_cond:
+                while len(self.conns) < num_connections:
+                    self.conn_cond.wait()
+        self.close_new = True
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _add_connection(self, reader, writer):
+        if self.close_new:
+            writer.close()
+            return
+        di_utils.apply_socket_options(writer.get_extra_info("socket"), self.socket_options)
+        res = (AsyncConnection(reader, writer, self.codec), writer.get_extra_info("peername"))
+        try:
+            await asyncio.wait_for(self._read_hello(res[0], res[1]), 5)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            print("Connection {} did not complete the handshake: {}".format(res[1], e))
+            writer.close()
+            return
+        with self.conn_cond:
+            self.conns.append(res)
+            self.conn_cond.notify_all()
+        print("Added a new connection, {}. {} connections total"
+              .format(res[1], len(self.conns)))
+
+    async def _read_hello(self, conn, address):
+
+        header = await conn.reader.readexactly(protocol.HELLO_HEADER.size)
+        flags, name_length, slots, slot_size, nonce = protocol.unpack_hello_header(header)
+        name = (await conn.reader.readexactly(name_length)).decode()
+
+        if flags & protocol.HELLO_FLAG_SHM:
+            # Imported here, so hosts without multiprocessing.shared_memory (before Python 3.8) still serve sockets
+            from frame_ring import attach_offered_ring
+            conn.ring = attach_offered_ring(address, name, slots, slot_size, nonce)
+            if conn.ring is not None:
+                # The relay is on this machine, so images go uncompressed through shared memory
+                conn.codec = RawCodec()
+
+    async def _close(self):
+        self.server.close()
+        for conn in self.conns:
+            conn[0].close()
+        await self.server.wait_closed()
+
+    def close(self):
+        self.close_new = True
+        self.run(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def get_infer_result(self, conn):
+        res = await self.get_frame_result(conn)
+        if res is None:
+            return None
+        return res[1]
+
+    async def get_frame_result(self, conn):
+        res = await self.get_frame_timing(conn)
+        if res is None:
+            return None
+        return res[:2]
+
+    async def get_frame_timing(self, conn):
+
+        if self.verbose:
+            print("Starting retrieval of message")
+
+        try:
+            header = await conn.reader.readexactly(protocol.RESULT_HEADER.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+        received = time.time_ns()
+        flags, frame_id, num_results, timestamps = protocol.unpack_result_header(header)
+        timestamps = timestamps._replace(host_received=received)
+        conn.clock.update(timestamps.host_sent, timestamps.relay_received, timestamps.relay_sent, received)
+
+        self.first_rec_time = time.time()
+        if self.verbose:
+            print("Getting results for frame {} with {} props".format(frame_id, num_results))
+
+        try:
+            data = await conn.reader.readexactly(num_results * protocol.RESULT_DTYPE.itemsize)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("ERROR: Inference signal stopped mid-transmission")
+            return None
+
+        results = protocol.unpack_results(data, num_results)
+
+        if flags & protocol.RESULT_FLAG_DROPPED:
+            if self.verbose:
+                print("Frame {} was dropped by the relay".format(frame_id))
+            return frame_id, None, timestamps
+
+        if self.verbose:
+            print("Got props {}".format(results))
+
+        return frame_id, results, timestamps
+
+    def get_clock(self, conn):
+        return conn.clock
+
+    def set_codec(self, conn, codec):
+        conn.codec = codec
+
+    def get_codec(self, conn):
+        return conn.codec
+
+    def uses_shared_memory(self, conn):
+        return conn.ring is not None
+
+    async def send_image(self, conn, img, frame_id=0, encoded=None):
+        h, w = img.shape[:2]
+        if encoded is None:
+            data = conn.codec.encode(img)
+        else:
+            # Shared by the caller across connections, so the image is only encoded once per codec
+            key = (conn.codec.codec_id, conn.codec.quality)
+            if key not in encoded:
+                encoded[key] = conn.codec.encode(img)
+            data = encoded[key]
+        await self.send_encoded(conn, data, conn.codec.codec_id, h, w, frame_id)
+
+    async def send_encoded(self, conn, data, codec_id, height, width, frame_id=0):
+        await self.send_encoded_batch(conn, [(data, codec_id, height, width, frame_id)])
+
+    async def send_batch(self, conn, frames):
+        await self.send_encoded_batch(conn, [(conn.codec.encode(img), conn.codec.codec_id, img.shape[0], img.shape[1],
+                                              frame_id) for frame_id, img in frames])
+
+    async def send_encoded_batch(self, conn, images):
+
+        if not 0 < len(images) <= protocol.MAX_BATCH:
+            raise ValueError("AsyncHost: Batch size must be between 1 and {}".format(protocol.MAX_BATCH))
+
+        sent = time.time_ns()
+        rtt = conn.clock.rtt // 1000
+        buffers = []
+        for i, (data, codec_id, height, width, frame_id) in enumerate(images):
+            if conn.ring is not None:
+                data, codec_id = conn.ring.message(data, codec_id)
+            buffers.append(protocol.pack_image_header(frame_id, codec_id, height, width, len(data), sent=sent,
+                                                      rtt=rtt, batch=len(images) if i == 0 else 0))
+            buffers.append(memoryview(data).cast("B"))
+        conn.writer.writelines(buffers)
+        await conn.writer.drain()
+
+    def get_connections(self):
+        return self.conns.copy()
+
+
+class BlockingHost:
+
+    def __init__(self, host):
+        self.host = host
+        self.conns = host.conns
+
+    def close(self):
+        self.host.close()
+
+    def get_infer_result(self, conn):
+        return self.host.run(self.host.get_infer_result(conn))
+
+    def get_frame_result(self, conn):
+        return self.host.run(self.host.get_frame_result(conn))
+
+    def get_frame_timing(self, conn):
+        return self.host.run(self.host.get_frame_timing(conn))
+
+    def get_clock(self, conn):
+        return self.host.get_clock(conn)
+
+    def set_codec(self, conn, codec):
+        self.host.set_codec(conn, codec)
+
+    def get_codec(self, conn):
+        return self.host.get_codec(conn)
+
+    def uses_shared_memory(self, conn):
+        return self.host.uses_shared_memory(conn)
+
+    def send_image(self, conn, img, frame_id=0, encoded=None):
+        self.host.run(self.host.send_image(conn, img, frame_id, encoded))
+
+    def send_encoded(self, conn, data, codec_id, height, width, frame_id=0):
+        self.host.run(self.host.send_encoded(conn, data, codec_id, height, width, frame_id))
+
+    def send_batch(self, conn, frames):
+        self.host.run(self.host.send_batch(conn, frames))
+
+    def send_encoded_batch(self, conn, images):
+        self.host.run(self.host.send_encoded_batch(conn, images))
+
+    def get_connections(self):
+        return self.host.get_connections()
+
+
+async def _test_connection(host, idx, conn, frame, encoded):
+
+    send_start = time.time()
+    await host.send_image(conn, frame, encoded=encoded)
+    send_end = time.time()
+    result = await host.get_infer_result(conn)
+    get_end = time.time()
+    print("Connection {}: Send: {}ms | Get: {}ms | Total: {}ms | {} props"
+          .format(idx, round((send_end - send_start) * 1000, 3), round((get_end - send_end) * 1000, 3),
+                  round((get_end - send_start) * 1000, 3), None if result is None else len(result)))
+
+
+async def _test_all(host, frame):
+    # Connections with the same codec share one encoded image
+    encoded = {}
+    await asyncio.gather(*[_test_connection(host, idx, conn[0], frame, encoded)
+                           for idx, conn in enumerate(host.get_connections())])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", "-i", help="File path to input image", required=True)
+    parser.add_argument("--port", "-p", help="Listening port to use", default=8080, type=int)
+    args = parser.parse_args()
+
+    host = AsyncHost(args.port)
+
+    img = cv2.imread(args.input)
+    frame = cv2.resize(img, (300, 300))
+
+    start = time.time()
+    host.run(_test_all(host, frame))
+    print("Inferred on {} connections in {}ms".format(len(host.conns), round((time.time() - start) * 1000, 3)))
+
+    host.close()
+
+
+if __name__ == '__main__':
+    main()
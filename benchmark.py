@@ -0,0 +1,349 @@
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import di_utils
+from codec import CODECS
+from client_sim import PROFILES
+from gate import MotionGate
+from protocol import RESULT_DTYPE
+from result_cache import CACHE_MODES, ResultCache
+from scheduler import SCHEDULERS
+from stream import DistributedStream
+
+CLIENT_SIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client_sim.py")
+
+# Pseudo-codec for runs where the clients receive raw frames through shared memory
+SHM_CODEC = "shm"
+
+# Metrics where a lower value is better, compared in compare mode along with FPS
+LOWER_IS_BETTER = ["latency_p50", "latency_p95", "latency_p99", "host_cpu_per_frame", "client_cpu_per_frame"]
+
+# Run settings that change the workload of every run, with the values files written before they existed imply
+WORKLOAD_CONFIG = {"frames": 200, "profiles": ["edgetpu", "jetson", "upsquared"], "scheduler": "first",
+                   "use_async": False, "hold": 1, "gate": False, "keyframe_interval": 1,
+                   "tile_size": None, "cache": None}
+
+
+def synthetic_frames(width, height, count, distinct=30, hold=1):
+    # A gradient with a moving box, so the codecs see realistic rather than random content
+    x, y = np.meshgrid(np.linspace(0, 255, width), np.linspace(0, 255, height))
+    background = np.stack([x, y, (x + y) / 2], axis=-1).astype(np.uint8)
+
+    frames = []
+    size = max(min(width, height) // 4, 1)
+    for i in range(distinct):
+        img = background.copy()
+        left = (i * width // distinct) % max(width - size, 1)
+        top = (i * height // distinct) % max(height - size, 1)
+        cv2.rectangle(img, (left, top), (left + size, top + size), (40, 200, 40), -1)
+        frames.append(img)
+
+    # Distinct frames are reused, so long runs do not hold every frame in memory. Each one is shown for hold frames in a
+    # row, which makes the scene static in between
+    return [frames[i // hold % distinct] for i in range(count)]
+
+
+def parse_size(size):
+    w, h = size.lower().split("x")
+    return int(w), int(h)
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class LoopbackBenchmark:
+
+    def __init__(self, port=9000, frames=200, profiles=None, scheduler="first", use_async=False, client_args=None,
+                 timeout=30, verbose=False, hold=1, motion_gate=False, keyframe_interval=1, tile_size=None,
+                 cache=None):
+
+        self.port = port
+        self.frames = frames
+        self.profiles = profiles if profiles else ["edgetpu", "jetson", "upsquared"]
+        self.scheduler = scheduler
+        self.use_async = use_async
+        self.client_args = client_args if client_args else []
+        self.timeout = timeout
+        self.verbose = verbose
+        self.hold = hold
+        self.motion_gate = motion_gate
+        self.keyframe_interval = keyframe_interval
+        self.tile_size = tile_size
+        self.cache = cache
+
+        self.runs = 0
+
+    def _start_clients(self, port, devices, batch, shared_memory=False):
+        clients = []
+        for i in range(devices):
+            args = [sys.executable, CLIENT_SIM, "-i", "127.0.0.1:{}".format(port),
+                    "-p", self.profiles[i % len(self.profiles)], "--seed", str(i), "--connect_timeout",
+                    str(self.timeout), "-r", "3600", "-b", str(batch)] + self.client_args
+            if shared_memory:
+                args.append("--shared_memory")
+            clients.append(subprocess.Popen(args, stdout=None if self.verbose else subprocess.DEVNULL))
+        return clients
+
+    def _stop_clients(self, clients):
+        for client in clients:
+            try:
+                client.wait(self.timeout)
+            except subprocess.TimeoutExpired:
+                print("Client {} did not exit, killing it".format(client.pid))
+                client.kill()
+                client.wait()
+
+    def run(self, size, codec, devices, window, batch=1):
+
+        # Every run listens on a new port, so it does not wait for the previous one to leave TIME_WAIT
+        port = self.port + self.runs
+        self.runs += 1
+
+        width, height = parse_size(size)
+        frames = synthetic_frames(width, height, self.frames, hold=self.hold)
+
+        client_cpu = _children_cpu()
+        shared_memory = codec == SHM_CODEC
+        clients = self._start_clients(port, devices, batch, shared_memory)
+        try:
+            stream = DistributedStream(port, None, self.verbose, window, self.use_async, self.scheduler,
+                                       codec="raw" if shared_memory else codec,
+                                       num_connections=devices, batch_size=batch,
+                                       motion_gate=MotionGate() if self.motion_gate else None,
+                                       keyframe_interval=self.keyframe_interval, tile_size=self.tile_size,
+                                       result_cache=ResultCache(self.cache) if self.cache else None)
+            try:
+                stats = stream.stream_video(frames, output=None)
+                transmission = stream.watch.snapshot()
+            finally:
+                stream.close()
+        finally:
+            self._stop_clients(clients)
+        client_cpu = _children_cpu() - client_cpu
+
+        latency = stats["latency"]
+        num_frames = max(stats["frames"], 1)
+        return {
+            "size": size,
+            "codec": codec,
+            "devices": devices,
+            "window": window,
+            "batch": batch,
+            "frames": stats["frames"],
+            "skipped": stats["skipped"],
+            "gated": stats["gated"],
+            "cache_hits": stats["cache_hits"],
+            "fps": stats["fps"],
+            "inferred_fps": stats["inferred_fps"],
+            "latency_p50": latency["p50"],
+            "latency_p95": latency["p95"],
+            "latency_p99": latency["p99"],
+            "host_cpu_per_frame": stats["cpu_time"] * 1000 / num_frames,
+            "client_cpu_per_frame": client_cpu * 1000 / num_frames,
+            "transmission": {name: times for name, times in transmission.items() if times["total"]["count"]},
+        }
+
+    def sweep(self, sizes, codecs, devices, windows, batches=(1,)):
+
+        results = []
+        for size, codec, num_devices, window, batch in itertools.product(sizes, codecs, devices, windows, batches):
+            if batch > window:
+                # A batch can never fill with fewer frames in flight
+                continue
+            print("==== {} {} devices={} window={} batch={} ====".format(size, codec, num_devices, window, batch))
+            res = self.run(size, codec, num_devices, window, batch)
+            print("{} FPS ({} inferred), latency p50 {}ms p95 {}ms p99 {}ms, CPU per frame: host {}ms clients {}ms"
+                  .format(round(res["fps"], 3), round(res["inferred_fps"], 3), round(res["latency_p50"], 3),
+                          round(res["latency_p95"], 3), round(res["latency_p99"], 3),
+                          round(res["host_cpu_per_frame"], 3), round(res["client_cpu_per_frame"], 3)))
+            results.append(res)
+        return results
+
+
+def synthetic_results(count, rng, classes=90):
+    # Boxes in the 300x300 model space, as they arrive from the clients
+    results = np.zeros(count, dtype=RESULT_DTYPE)
+    corners = np.sort(rng.integers(0, 300, (count, 2, 2)), axis=1)
+    results["x1"], results["y1"] = corners[:, 0, 0], corners[:, 0, 1]
+    results["x2"], results["y2"] = corners[:, 1, 0], corners[:, 1, 1]
+    results["cls"] = rng.integers(1, classes + 1, count)
+    results["conf"] = rng.uniform(0.5, 1., count)
+    return results
+
+
+def overlay_benchmark(size, detections, iterations=200, classes=10, seed=0):
+
+    width, height = parse_size(size)
+    img = synthetic_frames(width, height, 1)[0]
+    labels = {i: "class {}".format(i) for i in range(91)}
+    rng = np.random.default_rng(seed)
+    results = [synthetic_results(detections, rng, classes) for _ in range(iterations)]
+
+    # The previous stitching path: a copy of the frame, per-box scaling in Python and draw_labels
+    start = time.perf_counter()
+    for result in results:
+        labeled_img = np.copy(img)
+        result = [((int(x1 * width / 300),
+                    int(y1 * height / 300),
+                    int(x2 * width / 300),
+                    int(y2 * height / 300), cls, conf)) for (x1, y1, x2, y2, cls, conf) in result.tolist()]
+        di_utils.draw_labels(labeled_img, result, labels=labels)
+    baseline = (time.perf_counter() - start) / iterations
+
+    renderer = di_utils.LabelRenderer(labels)
+    frame = np.copy(img)
+    start = time.perf_counter()
+    for result in results:
+        renderer.draw(frame, result, width / 300, height / 300)
+    cached = (time.perf_counter() - start) / iterations
+
+    return {
+        "size": size,
+        "detections": detections,
+        "classes": classes,
+        "draw_labels_ms": baseline * 1000,
+        "renderer_ms": cached * 1000,
+        "speedup": baseline / cached if cached > 0 else 0.,
+        "patch_hit_rate": renderer.hits / max(renderer.hits + renderer.misses, 1),
+    }
+
+
+def _run_key(run):
+    return run["size"], run["codec"], run["devices"], run["window"], run.get("batch", 1)
+
+
+def _config_differences(base, new):
+    base_config, new_config = base.get("config", {}), new.get("config", {})
+    return [(name, base_config.get(name, default), new_config.get(name, default))
+            for name, default in WORKLOAD_CONFIG.items()
+            if base_config.get(name, default) != new_config.get(name, default)]
+
+
+def compare(base, new, threshold=0.1):
+
+    differences = _config_differences(base, new)
+    if differences:
+        raise ValueError("benchmark: Results were made with different settings: {}".format(
+            ", ".join("{} {} -> {}".format(name, before, after) for name, before, after in differences)))
+
+    base_runs = {_run_key(run): run for run in base["runs"]}
+    regressions = []
+
+    for run in new["runs"]:
+        key = _run_key(run)
+        if key not in base_runs:
+            continue
+        old = base_runs[key]
+
+        changes = []
+        if old["fps"] > 0 and run["fps"] < old["fps"] * (1 - threshold):
+            changes.append(("fps", old["fps"], run["fps"]))
+        for metric in LOWER_IS_BETTER:
+            if old[metric] > 0 and run[metric] > old[metric] * (1 + threshold):
+                changes.append((metric, old[metric], run[metric]))
+
+        name = "{} {} devices={} window={} batch={}".format(*key)
+        if changes:
+            regressions.append((name, changes))
+            for metric, before, after in changes:
+                print("REGRESSION {}: {} {} -> {}".format(name, metric, round(before, 3), round(after, 3)))
+        else:
+            print("OK {}: {} FPS -> {} FPS".format(name, round(old["fps"], 3), round(run["fps"], 3)))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run a benchmark sweep over loopback")
+    run_parser.add_argument("--output", "-o", help="Path of the JSON results file", default="benchmark.json")
+    run_parser.add_argument("--port", "-p", help="First listening port; each run uses the next one", default=9000,
+                            type=int)
+    run_parser.add_argument("--frames", "-n", help="Number of frames per run", default=200, type=int)
+    run_parser.add_argument("--sizes", help="Frame sizes (WxH)", nargs="+", default=["300x300", "640x480", "1280x720"])
+    run_parser.add_argument("--codecs", help="Image codecs; shm sends raw frames through shared memory", nargs="+",
+                            default=["raw", "jpeg"], choices=list(CODECS) + [SHM_CODEC])
+    run_parser.add_argument("--devices", help="Numbers of simulated devices", nargs="+", default=[1, 3], type=int)
+    run_parser.add_argument("--windows", help="In-flight windows", nargs="+", default=[1, 2, 4], type=int)
+    run_parser.add_argument("--batches", help="Batch sizes; combinations with a batch larger than the window are "
+                                              "skipped", nargs="+", default=[1], type=int)
+    run_parser.add_argument("--profiles", help="Device profiles, assigned to the devices in turn", nargs="+",
+                            default=["edgetpu", "jetson", "upsquared"], choices=list(PROFILES))
+    run_parser.add_argument("--scheduler", help="Device scheduling policy", default="first", choices=SCHEDULERS)
+    run_parser.add_argument("--async", dest="use_async", help="Use the asyncio host", action="store_true")
+    run_parser.add_argument("--hold", help="Number of frames each synthetic frame is repeated for, to simulate a "
+                                           "static scene", default=1, type=int)
+    run_parser.add_argument("--gate", help="Reuse the previous detections for frames without motion",
+                            action="store_true")
+    run_parser.add_argument("--keyframe_interval", "-k", help="Infer every k-th frame and track boxes in between",
+                            default=1, type=int)
+    run_parser.add_argument("--tile_size", help="Split frames into overlapping tiles of this size, inferred in "
+                                                "parallel", type=int)
+    run_parser.add_argument("--cache", help="Answer repeated frames from a result cache with exact or perceptual keys",
+                            choices=CACHE_MODES)
+    run_parser.add_argument("--verbose", "-v", help="Show the stream and client output", action="store_true")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two benchmark results files")
+    compare_parser.add_argument("base", help="Baseline results file")
+    compare_parser.add_argument("new", help="New results file")
+    compare_parser.add_argument("--threshold", "-t", help="Relative change treated as a regression", default=0.1,
+                                type=float)
+
+    overlay_parser = subparsers.add_parser("overlay", help="Compare draw_labels with the cached label renderer")
+    overlay_parser.add_argument("--sizes", help="Frame sizes (WxH)", nargs="+", default=["640x480", "1280x720"])
+    overlay_parser.add_argument("--detections", help="Numbers of detections per frame", nargs="+",
+                                default=[10, 50, 200], type=int)
+    overlay_parser.add_argument("--iterations", "-n", help="Frames drawn per measurement", default=200, type=int)
+    overlay_parser.add_argument("--classes", help="Number of distinct classes among the detections", default=10,
+                                type=int)
+    args = parser.parse_args()
+
+    if args.command == "overlay":
+        for size, detections in itertools.product(args.sizes, args.detections):
+            res = overlay_benchmark(size, detections, args.iterations, args.classes)
+            print("{} detections={}: draw_labels {}ms, renderer {}ms ({}x, patch hit rate {}%)".format(
+                size, detections, round(res["draw_labels_ms"], 3), round(res["renderer_ms"], 3),
+                round(res["speedup"], 2), round(res["patch_hit_rate"] * 100, 1)))
+        return
+
+    if args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        try:
+            regressions = compare(base, new, args.threshold)
+        except ValueError as e:
+            print(e)
+            sys.exit(2)
+        print("{} regressions".format(len(regressions)))
+        sys.exit(1 if regressions else 0)
+
+    bench = LoopbackBenchmark(args.port, args.frames, args.profiles, args.scheduler, args.use_async,
+                              verbose=args.verbose, hold=args.hold, motion_gate=args.gate,
+                              keyframe_interval=args.keyframe_interval, tile_size=args.tile_size,
+                              cache=args.cache)
+    started = time.time()
+    runs = bench.sweep(args.sizes, args.codecs, args.devices, args.windows, args.batches)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("command", "output", "verbose")}
+    with open(args.output, "w") as f:
+        json.dump({"timestamp": started, "config": config, "runs": runs}, f, indent=2)
+    print("Wrote {} runs to {}".format(len(runs), args.output))
+
+
+if __name__ == '__main__':
+    main()
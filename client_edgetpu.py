@@ -3,58 +3,35 @@
 import argparse
 import cv2
 
-from tcp_latency import measure_latency
-
 from edgetpu.detection.engine import DetectionEngine
+from client_runtime import Backend, ClientRuntime
 from relay import Relay
 from stopwatch import Stopwatch
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--model', help='Path of the detection model.', required=True, type=str)
-    parser.add_argument('--ip', "-i", help='File path of the input image.', required=True, type=str)
-    parser.add_argument('--report_interval', '-r', help="Duration of reporting interval, in seconds", default=10,
-                        type=int)
-    parser.add_argument('-v', "--verbose", help="Print information about detected objects", action='store_true')
-    args = parser.parse_args()
-
-    relay = Relay(args.ip, args.verbose)
-
-    engine = DetectionEngine(args.model)
-
-    watch = Stopwatch()
-
-    while True:
+class EdgeTPUBackend(Backend):
 
-        if args.verbose:
-            print("ready for next inference")
-        img = relay.get_image()
+    def __init__(self, model):
+        self.model = model
+        self.engine = None
 
-        if img is None:
-            break
+    def load(self):
+        self.engine = DetectionEngine(self.model)
 
-        if args.verbose:
-            print("Received image ", watch.numread)
-
-        watch.start()
+    def preprocess(self, img):
         initial_h, initial_w, _ = img.shape
         if (initial_h, initial_w) != (300, 300):
             frame = cv2.resize(img, (300, 300))
         else:
             frame = img
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        watch.stop(Stopwatch.MODE_PREPROCESS)
-
-        watch.start()
-        ans = engine.detect_with_input_tensor(frame.flatten(), threshold=0.5, top_k=10)
-        watch.stop(Stopwatch.MODE_INFER)
+        return frame.flatten(), (initial_w, initial_h)
 
-        if args.verbose:
-            print("Got inference results for frame ", watch.numread, ": ", ans)
+    def infer(self, tensor):
+        return self.engine.detect_with_input_tensor(tensor, threshold=0.5, top_k=10)
 
-        watch.start()
-        # Display result
+    def postprocess(self, ans, meta):
+        initial_w, initial_h = meta
         results = []
         for obj in ans:
             box = obj.bounding_box.flatten().tolist()
@@ -66,15 +43,43 @@ def main():
 
             result = (bbox, obj.label_id + 1, obj.score)
             results.append(result)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='Path of the detection model.', required=True, type=str)
+    parser.add_argument('--ip', "-i", help='File path of the input image.', required=True, type=str)
+    parser.add_argument('--report_interval', '-r', help="Duration of reporting interval, in seconds", default=10,
+                        type=int)
+    parser.add_argument('--histogram_window', help="Only report latency percentiles over roughly the last this many "
+                                                   "seconds", type=float)
+    parser.add_argument('--histogram_output', help="Write the final latency percentiles to this JSON file")
+    parser.add_argument('-v', "--verbose", help="Print information about detected objects", action='store_true')
+    parser.add_argument('--queue_size', '-q', help="Maximum number of received frames to buffer", default=16, type=int)
+    parser.add_argument('--latest_only', help="Drop the oldest buffered frame when the buffer is full",
+                        action='store_true')
+    parser.add_argument('--shared_memory', help="Receive frames through shared memory when the host is on this machine",
+                        action='store_true')
+    parser.add_argument('--stage_queue_size', help="Maximum number of frames waiting between pipeline stages",
+                        default=2, type=int)
+    args = parser.parse_args()
 
-        relay.send_results(results)
+    relay = Relay(args.ip, args.verbose, args.queue_size, args.latest_only, shared_memory=args.shared_memory)
 
-        watch.stop(Stopwatch.MODE_POSTPROCESS)
+    def report_latency():
+        print("Round trip time to source: ", round(relay.rtt * 1000, 3), "ms")
+        if args.latest_only:
+            print("Frames dropped by the relay: ", relay.dropped)
 
-        if watch.report():
-            print("TCP Latency to source: ", round(measure_latency(host=args.ip, port=relay.port)[0], 3), "ms")
+    watch = Stopwatch(args.report_interval, args.histogram_window)
+    runtime = ClientRuntime(relay, EdgeTPUBackend(args.model), watch, args.stage_queue_size, args.verbose,
+                            report_latency)
+    runtime.run()
 
     relay.close()
+    if args.histogram_output:
+        watch.export(args.histogram_output)
 
 
 if __name__ == '__main__':
@@ -21,14 +21,17 @@
 from __future__ import print_function
 import sys
 import os
+import queue
+import threading
+import time
 from argparse import ArgumentParser, SUPPRESS
 import cv2
 import numpy as np
 import logging as log
 from openvino.inference_engine import IECore, IENetwork
 
-from tcp_latency import measure_latency
-
+from client_runtime import Backend, ClientRuntime
+from postprocess import ssd_postprocess
 from relay import Relay
 from stopwatch import Stopwatch
 
@@ -52,10 +55,149 @@ def build_argparser():
     args.add_argument("-nt", "--number_top", help="Optional. Number of top results", default=10, type=int)
     args.add_argument('--report_interval', '-r', help="Duration of reporting interval, in seconds", default=10,
                       type=int)
+    args.add_argument("--histogram_window", help="Optional. Only report latency percentiles over roughly the last "
+                                                 "this many seconds", type=float)
+    args.add_argument("--histogram_output", help="Optional. Write the final latency percentiles to this JSON file")
     args.add_argument("--verbose", "-v", help="Print inference results", action='store_true')
+    args.add_argument("-nireq", "--num_requests", help="Optional. Number of infer requests; more than 1 runs inference "
+                                                       "asynchronously", default=1, type=int)
+    args.add_argument("--stage_queue_size", help="Optional. Maximum number of frames waiting between pipeline stages",
+                      default=2, type=int)
+    args.add_argument("-q", "--queue_size", help="Optional. Maximum number of received frames to buffer",
+                      default=16, type=int)
+    args.add_argument("--latest_only", help="Optional. Drop the oldest buffered frame when the buffer is full",
+                      action='store_true')
+    args.add_argument("--shared_memory", help="Optional. Receive frames through shared memory when the host is on "
+                                              "this machine", action='store_true')
+    args.add_argument("-b", "--batch_size", help="Optional. Maximum number of buffered frames to infer at once. Only "
+                                                 "used with a single infer request", default=1, type=int)
     return parser
 
 
+class OpenVINOBackend(Backend):
+
+    def __init__(self, exec_net, data, input_name, out_blob, h, w, batch_size=1):
+        self.exec_net = exec_net
+        self.data = data
+        self.input_name = input_name
+        self.out_blob = out_blob
+        self.h = h
+        self.w = w
+        self.max_batch_size = batch_size
+
+    def preprocess(self, img):
+        ih, iw = img.shape[:-1]
+        if (ih, iw) != (self.h, self.w):
+            img = cv2.resize(img, (self.w, self.h))
+        return img.transpose((2, 0, 1)), (ih, iw)  # Change data layout from HWC to CHW
+
+    def infer(self, tensor):
+        if self.max_batch_size > 1:
+            return self.infer_batch([tensor])[0]
+        self.data[self.input_name] = tensor
+        res = self.exec_net.infer(inputs=self.data)
+        return res[self.out_blob][0][0].copy()
+
+    def infer_batch(self, tensors):
+
+        # The network has a fixed batch size, so a partial batch is padded with the last image
+        batch = np.stack(tensors + tensors[-1:] * (self.max_batch_size - len(tensors)))
+        self.data[self.input_name] = batch
+        res = self.exec_net.infer(inputs=self.data)[self.out_blob][0][0]
+
+        # Detections of the whole batch share one output, tagged with the image index in the first column
+        return [res[res[:, 0] == i].copy() for i in range(len(tensors))]
+
+    def postprocess(self, output, meta):
+        ih, iw = meta
+        return ssd_postprocess(output, iw, ih, skip_classes=(0,))
+
+
+def run_async(args, relay, watch, backend, report_latency):
+
+    idle = queue.Queue()
+    for request_id in range(args.num_requests):
+        idle.put(request_id)
+
+    # Sequence number -> request id, filled by the completion callbacks and drained in frame order
+    completed = {}
+    completed_cond = threading.Condition()
+    inflight = {}
+    # Number of frames started, set once the relay closes
+    end = []
+
+    def on_complete(status, request_id):
+        with completed_cond:
+            seq = inflight[request_id][0]
+            completed[seq] = (request_id, time.time_ns())
+            completed_cond.notify_all()
+
+    for request_id in range(args.num_requests):
+        backend.exec_net.requests[request_id].set_completion_callback(on_complete, request_id)
+
+    def send_in_order():
+
+        next_seq = 0
+        while True:
+
+            with completed_cond:
+                while next_seq not in completed:
+                    if end and next_seq >= end[0]:
+                        return
+                    completed_cond.wait()
+                request_id, infer_end = completed.pop(next_seq)
+                seq, frame_id, meta, infer_start = inflight.pop(request_id)
+
+            watch.record(Stopwatch.MODE_INFER, (infer_end - infer_start) / 1e9)
+            relay.mark_infer(frame_id, infer_start, infer_end)
+
+            start_w, start_c = time.time(), time.thread_time()
+            res = backend.exec_net.requests[request_id].outputs[backend.out_blob][0][0]
+            results = backend.postprocess(res, meta)
+            idle.put(request_id)
+
+            if args.verbose:
+                print(results)
+            relay.send_results(results, frame_id)
+            watch.record(Stopwatch.MODE_POSTPROCESS, time.time() - start_w, time.thread_time() - start_c)
+
+            if watch.report():
+                report_latency()
+
+            next_seq += 1
+
+    sender = threading.Thread(target=send_in_order, daemon=True)
+    sender.start()
+
+    seq = 0
+    while True:
+
+        frame = relay.get_frame()
+
+        if frame is None:
+            break
+
+        frame_id, img = frame
+
+        start_w, start_c = time.time(), time.thread_time()
+        tensor, meta = backend.preprocess(img)
+        watch.record(Stopwatch.MODE_PREPROCESS, time.time() - start_w, time.thread_time() - start_c)
+
+        # Preprocessing of the next frame overlaps inference of the frames already started
+        request_id = idle.get()
+        backend.data[backend.input_name] = tensor
+        with completed_cond:
+            inflight[request_id] = (seq, frame_id, meta, time.time_ns())
+        backend.exec_net.start_async(request_id=request_id, inputs=backend.data)
+        seq += 1
+
+    # Stop the sender after the frames already started
+    with completed_cond:
+        end.append(seq)
+        completed_cond.notify_all()
+    sender.join()
+
+
 def main():
     log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
     args = build_argparser().parse_args()
@@ -93,6 +235,8 @@ def main():
 
     # -----------------------------------------3. Prepare input blobs ------------------------------------
 
+    if args.batch_size > 1 and args.num_requests == 1:
+        net.batch_size = args.batch_size
     log.info("Preparing input blobs")
     print("inputs number: " + str(len(net.inputs.keys())))
 
@@ -153,62 +297,28 @@ def main():
     # --------------------------- 5. Read, preproccess, inference, and write simultaneously ----------------------
 
     log.info("Loading model to the device")
-    exec_net = ie.load_network(network=net, device_name=args.device)
+    exec_net = ie.load_network(network=net, device_name=args.device, num_requests=args.num_requests)
     log.info("Running inference")
 
-    relay = Relay(args.ip)
-
-    watch = Stopwatch()
-
-    while True:
-
-        img = relay.get_image()
-
-        if img is None:
-            break
-
-        watch.start()
-        ih, iw = img.shape[:-1]
-        if (ih, iw) != (h, w):
-            img = cv2.resize(img, (w, h))
-        img = img.transpose((2, 0, 1))  # Change data layout from HWC to CHW
-        watch.stop(Stopwatch.MODE_PREPROCESS)
-
-        watch.start()
-        data[input_name] = img
-        res = exec_net.infer(inputs=data)
-        res = res[out_blob]
-        res = res[0][0]
-        watch.stop(Stopwatch.MODE_INFER)
-
-        watch.start()
-        results = []
-        for proposal in res:
-
-            if int(proposal[1]) == 0:
-                continue
-            if proposal[2] < 0.5:
-                continue
-
-            box = [0] * 4
-
-            box[0] = np.int(iw * proposal[3])
-            box[1] = np.int(ih * proposal[4])
-            box[2] = np.int(iw * proposal[5])
-            box[3] = np.int(ih * proposal[6])
+    relay = Relay(args.ip, args.verbose, args.queue_size, args.latest_only, shared_memory=args.shared_memory)
 
-            result = (box, int(proposal[1]), proposal[2])
-            results.append(result)
+    watch = Stopwatch(args.report_interval, args.histogram_window)
+    backend = OpenVINOBackend(exec_net, data, input_name, out_blob, h, w, net.batch_size)
 
-        if args.verbose:
-            print(results)
-        relay.send_results(results)
-        watch.stop(Stopwatch.MODE_POSTPROCESS)
+    def report_latency():
+        print("Round trip time to source: ", round(relay.rtt * 1000, 3), "ms")
+        if args.latest_only:
+            print("Frames dropped by the relay: ", relay.dropped)
 
-        if watch.report():
-            print("TCP Latency to source: ", round(measure_latency(host=args.ip, port=relay.port)[0], 3), "ms")
+    if args.num_requests > 1:
+        run_async(args, relay, watch, backend, report_latency)
+    else:
+        ClientRuntime(relay, backend, watch, args.stage_queue_size, args.verbose, report_latency,
+                      args.batch_size).run()
 
     relay.close()
+    if args.histogram_output:
+        watch.export(args.histogram_output)
 
     # -----------------------------------------------------------------------------------------------------
 
@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+
+from stopwatch import Stopwatch
+
+
+class Backend:
+
+    # Largest batch infer_batch accepts; known once the model is loaded
+    max_batch_size = 1
+
+    def load(self):
+        pass
+
+    def preprocess(self, img):
+        # Returns (tensor, meta), where meta is passed on to postprocess
+        raise NotImplementedError
+
+    def infer(self, tensor):
+        # The returned output must not be overwritten by the next call, since postprocess runs concurrently
+        raise NotImplementedError
+
+    def infer_batch(self, tensors):
+        # Returns one output per tensor
+        return [self.infer(tensor) for tensor in tensors]
+
+    def postprocess(self, output, meta):
+        # Returns results in a format accepted by Relay.send_results
+        raise NotImplementedError
+
+
+class ClientRuntime:
+
+    def __init__(self, relay, backend, watch=None, queue_size=2, verbose=False, on_report=None, batch_size=1):
+
+        if queue_size < 1:
+            raise ValueError("ClientRuntime: Queue size must be at least 1")
+        if batch_size < 1:
+            raise ValueError("ClientRuntime: Batch size must be at least 1")
+
+        self.relay = relay
+        self.backend = backend
+        self.watch = watch if watch else Stopwatch()
+        self.verbose = verbose
+        self.on_report = on_report
+        self.batch_size = batch_size
+
+        # Each item is a batch, which holds a single frame unless batching is enabled
+        self.infer_queue = queue.Queue(maxsize=queue_size)
+        self.post_queue = queue.Queue(maxsize=queue_size)
+
+    def _timed(self, mode, func, *args):
+        start_w, start_c = time.perf_counter_ns(), time.thread_time()
+        res = func(*args)
+        self.watch.record(mode, (time.perf_counter_ns() - start_w) / 1e9, time.thread_time() - start_c)
+        return res
+
+    def _record_batch(self, mode, size, wall, clock):
+        # Recorded once per frame, so averages and throughput count frames rather than batches
+        for _ in range(size):
+            self.watch.record(mode, wall / size, clock / size)
+
+    def _preprocess_loop(self):
+
+        while True:
+
+            frames = self.relay.get_frames(self.batch_size)
+            if frames is None:
+                self.infer_queue.put(None)
+                return
+
+            frame_ids, tensors, metas = [], [], []
+            for frame_id, img in frames:
+                if self.verbose:
+                    print("Received image ", frame_id)
+
+                tensor, meta = self._timed(Stopwatch.MODE_PREPROCESS, self.backend.preprocess, img)
+                frame_ids.append(frame_id)
+                tensors.append(tensor)
+                metas.append(meta)
+
+            self.infer_queue.put((frame_ids, tensors, metas))
+
+    def _infer_loop(self):
+
+        while True:
+
+            item = self.infer_queue.get()
+            if item is None:
+                self.post_queue.put(None)
+                return
+
+            frame_ids, tensors, metas = item
+            start, start_c = time.time_ns(), time.thread_time()
+            if len(tensors) == 1:
+                outputs = [self.backend.infer(tensors[0])]
+            else:
+                outputs = self.backend.infer_batch(tensors)
+            end = time.time_ns()
+            self._record_batch(Stopwatch.MODE_INFER, len(tensors), (end - start) / 1e9, time.thread_time() - start_c)
+            for frame_id in frame_ids:
+                self.relay.mark_infer(frame_id, start, end)
+            self.post_queue.put((frame_ids, outputs, metas))
+
+    def _postprocess_loop(self):
+
+        while True:
+
+            item = self.post_queue.get()
+            if item is None:
+                return
+
+            frame_ids, outputs, metas = item
+            start_w, start_c = time.perf_counter_ns(), time.thread_time()
+            batch = []
+            for frame_id, output, meta in zip(frame_ids, outputs, metas):
+                results = self.backend.postprocess(output, meta)
+                if self.verbose:
+                    print("Results for frame {}: {}".format(frame_id, results))
+                batch.append((frame_id, results))
+            # The results of a batch go back to the host together
+            self.relay.send_batch_results(batch)
+
+            self._record_batch(Stopwatch.MODE_POSTPROCESS, len(batch), (time.perf_counter_ns() - start_w) / 1e9,
+                               time.thread_time() - start_c)
+
+            if self.watch.report() and self.on_report:
+                self.on_report()
+
+    def run(self):
+
+        self.backend.load()
+        if self.batch_size > self.backend.max_batch_size:
+            print("Batch size {} is larger than the model supports, using {}"
+                  .format(self.batch_size, self.backend.max_batch_size))
+            self.batch_size = self.backend.max_batch_size
+
+        threads = [threading.Thread(target=self._infer_loop, daemon=True),
+                   threading.Thread(target=self._postprocess_loop, daemon=True)]
+        for t in threads:
+            t.start()
+
+        self._preprocess_loop()
+
+        for t in threads:
+            t.join()
@@ -0,0 +1,168 @@
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from client_runtime import Backend, ClientRuntime
+from postprocess import ssd_postprocess
+from relay import Relay
+from stopwatch import Stopwatch
+
+# Mean and standard deviation of inference latency in seconds, roughly matching the real devices
+PROFILES = {
+    "edgetpu": (0.015, 0.002),
+    "jetson": (0.030, 0.005),
+    "upsquared": (0.060, 0.010),
+}
+
+DISTRIBUTIONS = ["constant", "normal", "lognormal", "exponential"]
+
+
+class SimBackend(Backend):
+
+    def __init__(self, profile="jetson", latency=None, jitter=None, distribution="normal", speed=1.0,
+                 max_detections=10, stall_rate=0., stall_time=0.5, crash_rate=0., crash_after=None, seed=None,
+                 max_batch_size=16, batch_cost=0.25):
+
+        if profile not in PROFILES:
+            raise ValueError("SimBackend: Unknown profile {}".format(profile))
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("SimBackend: Unknown distribution {}".format(distribution))
+
+        mean, std = PROFILES[profile]
+        self.latency = latency if latency is not None else mean
+        self.jitter = jitter if jitter is not None else std
+        self.distribution = distribution
+        self.speed = speed
+        self.max_detections = max_detections
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.crash_rate = crash_rate
+        self.crash_after = crash_after
+        self.max_batch_size = max_batch_size
+        # Extra latency of each additional frame in a batch, relative to a single frame
+        self.batch_cost = batch_cost
+
+        self.rng = np.random.default_rng(seed)
+        self.inferred = 0
+
+    def _sample_latency(self):
+
+        if self.distribution == "constant":
+            latency = self.latency
+        elif self.distribution == "normal":
+            latency = self.rng.normal(self.latency, self.jitter)
+        elif self.distribution == "lognormal":
+            # Parameters chosen so the samples have the requested mean and standard deviation
+            sigma2 = np.log(1 + (self.jitter / self.latency) ** 2)
+            latency = self.rng.lognormal(np.log(self.latency) - sigma2 / 2, np.sqrt(sigma2))
+        else:
+            latency = self.rng.exponential(self.latency)
+
+        if self.rng.random() < self.stall_rate:
+            latency += self.stall_time
+
+        return max(latency, 0.) / self.speed
+
+    def preprocess(self, img):
+        ih, iw = img.shape[:-1]
+        if (iw, ih) != (300, 300):
+            img = cv2.resize(img, (300, 300))
+        return img, (iw, ih)
+
+    def infer(self, tensor):
+        return self.infer_batch([tensor])[0]
+
+    def infer_batch(self, tensors):
+
+        self.inferred += len(tensors)
+        if (self.crash_after is not None and self.inferred > self.crash_after) or self.rng.random() < self.crash_rate:
+            # Die like a device losing power, without closing the connection cleanly
+            print("Simulated crash after {} frames".format(self.inferred - len(tensors)))
+            os._exit(1)
+
+        time.sleep(self._sample_latency() * (1 + (len(tensors) - 1) * self.batch_cost))
+        return [self._detections() for _ in tensors]
+
+    def _detections(self):
+
+        # Synthetic DetectionOutput rows of [image_id, class, confidence, x1, y1, x2, y2]
+        n = self.rng.integers(0, self.max_detections + 1)
+        output = np.zeros((n, 7), dtype=np.float32)
+        output[:, 1] = self.rng.integers(1, 91, n)
+        output[:, 2] = self.rng.uniform(0.5, 1., n)
+        # Two random corners per box, sorted so x1 <= x2 and y1 <= y2
+        corners = np.sort(self.rng.uniform(0., 1., (n, 2, 2)), axis=1)
+        output[:, 3:7] = np.stack([corners[:, 0, 0], corners[:, 0, 1], corners[:, 1, 0], corners[:, 1, 1]], axis=1)
+        return output
+
+    def postprocess(self, output, meta):
+        iw, ih = meta
+        return ssd_postprocess(output, iw, ih)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ip', "-i", help='IP of the host, including port (ip:port)', required=True, type=str)
+    parser.add_argument('--profile', '-p', help="Device speed profile", default="jetson", choices=list(PROFILES))
+    parser.add_argument('--latency', help="Mean inference latency in ms (overrides the profile)", type=float)
+    parser.add_argument('--jitter', help="Standard deviation of inference latency in ms (overrides the profile)",
+                        type=float)
+    parser.add_argument('--distribution', '-d', help="Inference latency distribution", default="normal",
+                        choices=DISTRIBUTIONS)
+    parser.add_argument('--speed', '-s', help="Speed multiplier applied to the latency", default=1.0, type=float)
+    parser.add_argument('--max_detections', help="Maximum number of synthetic detections per frame", default=10,
+                        type=int)
+    parser.add_argument('--stall_rate', help="Probability of a latency spike on each frame", default=0., type=float)
+    parser.add_argument('--stall_time', help="Duration of a latency spike in ms", default=500., type=float)
+    parser.add_argument('--crash_rate', help="Probability of crashing on each frame", default=0., type=float)
+    parser.add_argument('--crash_after', help="Crash after this many frames", type=int)
+    parser.add_argument('--seed', help="Random seed", type=int)
+    parser.add_argument('--batch_size', '-b', help="Maximum number of buffered frames to infer at once", default=1,
+                        type=int)
+    parser.add_argument('--batch_cost', help="Extra latency of each additional frame in a batch, relative to one frame",
+                        default=0.25, type=float)
+    parser.add_argument('--connect_timeout', help="Keep retrying the connection to the host for this many seconds",
+                        default=0., type=float)
+    parser.add_argument('--report_interval', '-r', help="Duration of reporting interval, in seconds", default=10,
+                        type=int)
+    parser.add_argument('--histogram_window', help="Only report latency percentiles over roughly the last this many "
+                                                   "seconds", type=float)
+    parser.add_argument('--histogram_output', help="Write the final latency percentiles to this JSON file")
+    parser.add_argument('-v', "--verbose", help="Print information about detected objects", action='store_true')
+    parser.add_argument('--queue_size', '-q', help="Maximum number of received frames to buffer", default=16, type=int)
+    parser.add_argument('--latest_only', help="Drop the oldest buffered frame when the buffer is full",
+                        action='store_true')
+    parser.add_argument('--shared_memory', help="Receive frames through shared memory when the host is on this machine",
+                        action='store_true')
+    parser.add_argument('--stage_queue_size', help="Maximum number of frames waiting between pipeline stages",
+                        default=2, type=int)
+    args = parser.parse_args()
+
+    backend = SimBackend(args.profile,
+                         args.latency / 1000 if args.latency is not None else None,
+                         args.jitter / 1000 if args.jitter is not None else None,
+                         args.distribution, args.speed, args.max_detections, args.stall_rate, args.stall_time / 1000,
+                         args.crash_rate, args.crash_after, args.seed, max(args.batch_size, 1), args.batch_cost)
+
+    relay = Relay(args.ip, args.verbose, args.queue_size, args.latest_only, args.connect_timeout,
+                  args.shared_memory)
+
+    def report_latency():
+        print("Round trip time to source: ", round(relay.rtt * 1000, 3), "ms")
+        if args.latest_only:
+            print("Frames dropped by the relay: ", relay.dropped)
+
+    watch = Stopwatch(args.report_interval, args.histogram_window)
+    runtime = ClientRuntime(relay, backend, watch, args.stage_queue_size, args.verbose, report_latency, args.batch_size)
+    runtime.run()
+
+    relay.close()
+    if args.histogram_output:
+        watch.export(args.histogram_output)
+
+
+if __name__ == '__main__':
+    main()
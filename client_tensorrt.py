@@ -6,111 +6,129 @@ import cv2
 import numpy as np
 
 import pycuda.autoinit
-from tcp_latency import measure_latency
 import pycuda.driver as cuda
 import tensorrt as trt
 
+from client_runtime import Backend, ClientRuntime
+from postprocess import ssd_postprocess
 from relay import Relay
 from stopwatch import Stopwatch
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model", type=str)
-    parser.add_argument("--ip", type=str)
-    parser.add_argument("--verbose", "-v", action='store_true')
-    parser.add_argument('--report_interval', '-r', help="Duration of reporting interval, in seconds", default=10,
-                        type=int)
-    args = parser.parse_args()
 
-    relay = Relay(args.ip)
-
-    # Initialize TRT environment
-    input_shape = (300, 300)
-    trt_logger = trt.Logger(trt.Logger.INFO)
-    trt.init_libnvinfer_plugins(trt_logger, '')
-    with open(args.model, 'rb') as f, trt.Runtime(trt_logger) as runtime:
-        engine = runtime.deserialize_cuda_engine(f.read())
-
-    host_inputs = []
-    cuda_inputs = []
-    host_outputs = []
-    cuda_outputs = []
-    bindings = []
-    stream = cuda.Stream()
-
-    for binding in engine:
-        size = trt.volume(engine.get_binding_shape(binding)) * engine.max_batch_size
-        host_mem = cuda.pagelocked_empty(size, np.float32)
-        cuda_mem = cuda.mem_alloc(host_mem.nbytes)
-        bindings.append(int(cuda_mem))
-        if engine.binding_is_input(binding):
-            host_inputs.append(host_mem)
-            cuda_inputs.append(cuda_mem)
-        else:
-            host_outputs.append(host_mem)
-            cuda_outputs.append(cuda_mem)
-    context = engine.create_execution_context()
-
-    watch = Stopwatch()
-
-    while True:
-
-        img = relay.get_image()
-        print("Received image", watch.numread)
-
-        if img is None:
-            break
-
-        # Preprocessing:
-        watch.start()
+class TensorRTBackend(Backend):
+
+    def __init__(self, model, input_shape=(300, 300)):
+        self.model = model
+        self.input_shape = input_shape
+
+    def load(self):
+
+        # Initialize TRT environment
+        trt_logger = trt.Logger(trt.Logger.INFO)
+        trt.init_libnvinfer_plugins(trt_logger, '')
+        with open(self.model, 'rb') as f, trt.Runtime(trt_logger) as runtime:
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+
+        self.host_inputs = []
+        self.cuda_inputs = []
+        self.host_outputs = []
+        self.cuda_outputs = []
+        self.bindings = []
+        self.stream = cuda.Stream()
+
+        for binding in self.engine:
+            size = trt.volume(self.engine.get_binding_shape(binding)) * self.engine.max_batch_size
+            host_mem = cuda.pagelocked_empty(size, np.float32)
+            cuda_mem = cuda.mem_alloc(host_mem.nbytes)
+            self.bindings.append(int(cuda_mem))
+            if self.engine.binding_is_input(binding):
+                self.host_inputs.append(host_mem)
+                self.cuda_inputs.append(cuda_mem)
+            else:
+                self.host_outputs.append(host_mem)
+                self.cuda_outputs.append(cuda_mem)
+        self.context = self.engine.create_execution_context()
+        self.max_batch_size = self.engine.max_batch_size
+
+        # The CUDA context belongs to the loading thread, and inference runs on another one
+        self.cuda_context = pycuda.autoinit.context
+
+    def preprocess(self, img):
         ih, iw = img.shape[:-1]
-        if (iw, ih) != input_shape:
-            img = cv2.resize(img, input_shape)
+        if (iw, ih) != self.input_shape:
+            img = cv2.resize(img, self.input_shape)
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         img = img.transpose((2, 0, 1)).astype(np.float32)
         img *= (2.0 / 255.0)
         img -= 1.0
+        return img.ravel(), (iw, ih)
 
-        np.copyto(host_inputs[0], img.ravel())
-        watch.stop(Stopwatch.MODE_PREPROCESS)
+    def infer(self, tensor):
+        return self.infer_batch([tensor])[0]
 
-        watch.start()
-        cuda.memcpy_htod_async(cuda_inputs[0], host_inputs[0], stream)
-        context.execute_async(batch_size=1, bindings=bindings, stream_handle=stream.handle)
-        cuda.memcpy_dtoh_async(host_outputs[1], cuda_outputs[1], stream)
-        cuda.memcpy_dtoh_async(host_outputs[0], cuda_outputs[0], stream)
-        stream.synchronize()
-        watch.stop(Stopwatch.MODE_INFER)
+    def infer_batch(self, tensors):
 
-        # Postprocessing
-        watch.start()
-        output = host_outputs[0]
-        results = []
-        for prefix in range(0, len(output), 7):
+        # Bindings are laid out as max_batch_size consecutive images
+        n = len(tensors)
+        inputs = self.host_inputs[0].reshape(self.max_batch_size, -1)
+        outputs = self.host_outputs[0].reshape(self.max_batch_size, -1)
 
-            conf = float(output[prefix + 2])
-            if conf < 0.5:
-                continue
-            x1 = int(output[prefix + 3] * iw)
-            y1 = int(output[prefix + 4] * ih)
-            x2 = int(output[prefix + 5] * iw)
-            y2 = int(output[prefix + 6] * ih)
-            cls = int(output[prefix + 1])
-            results.append(((x1, y1, x2, y2), cls, conf))
+        self.cuda_context.push()
+        try:
+            for i, tensor in enumerate(tensors):
+                np.copyto(inputs[i], tensor)
+            cuda.memcpy_htod_async(self.cuda_inputs[0], self.host_inputs[0], self.stream)
+            self.context.execute_async(batch_size=n, bindings=self.bindings, stream_handle=self.stream.handle)
+            cuda.memcpy_dtoh_async(self.host_outputs[1], self.cuda_outputs[1], self.stream)
+            cuda.memcpy_dtoh_async(self.host_outputs[0], self.cuda_outputs[0], self.stream)
+            self.stream.synchronize()
+        finally:
+            self.cuda_context.pop()
 
-        if args.verbose:
-            print(results)
+        # The output buffer is reused by the next inference
+        return [outputs[i].copy() for i in range(n)]
 
-        relay.send_results(results)
+    def postprocess(self, output, meta):
+        iw, ih = meta
+        return ssd_postprocess(output, iw, ih)
 
-        watch.stop(Stopwatch.MODE_POSTPROCESS)
 
-        if watch.report():
-            print("TCP Latency to source: ", round(measure_latency(host=args.ip, port=relay.port)[0], 3), "ms")
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str)
+    parser.add_argument("--ip", type=str)
+    parser.add_argument("--verbose", "-v", action='store_true')
+    parser.add_argument('--report_interval', '-r', help="Duration of reporting interval, in seconds", default=10,
+                        type=int)
+    parser.add_argument('--histogram_window', help="Only report latency percentiles over roughly the last this many "
+                                                   "seconds", type=float)
+    parser.add_argument('--histogram_output', help="Write the final latency percentiles to this JSON file")
+    parser.add_argument('--queue_size', '-q', help="Maximum number of received frames to buffer", default=16, type=int)
+    parser.add_argument('--latest_only', help="Drop the oldest buffered frame when the buffer is full",
+                        action='store_true')
+    parser.add_argument('--shared_memory', help="Receive frames through shared memory when the host is on this machine",
+                        action='store_true')
+    parser.add_argument('--stage_queue_size', help="Maximum number of frames waiting between pipeline stages",
+                        default=2, type=int)
+    parser.add_argument('--batch_size', '-b', help="Maximum number of buffered frames to infer at once", default=1,
+                        type=int)
+    args = parser.parse_args()
+
+    relay = Relay(args.ip, args.verbose, args.queue_size, args.latest_only, shared_memory=args.shared_memory)
 
-    relay.close()
+    def report_latency():
+        print("Round trip time to source: ", round(relay.rtt * 1000, 3), "ms")
+        if args.latest_only:
+            print("Frames dropped by the relay: ", relay.dropped)
 
+    watch = Stopwatch(args.report_interval, args.histogram_window)
+    runtime = ClientRuntime(relay, TensorRTBackend(args.model), watch, args.stage_queue_size, args.verbose,
+                            report_latency, args.batch_size)
+    runtime.run()
 
+    relay.close()
+    if args.histogram_output:
+        watch.export(args.histogram_output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+from collections import deque
+
+# Stages of a frame's round trip, in order, as returned by ClockEstimator.breakdown
+STAGES = ["upload", "decode", "queue", "infer", "reply", "download"]
+
+
+class ClockEstimator:
+
+    def __init__(self, window=32):
+
+        if window < 1:
+            raise ValueError("ClockEstimator: Window must be at least 1")
+
+        # (rtt, offset) of the most recent exchanges, all in ns
+        self.samples = deque(maxlen=window)
+        self.offset = 0
+        self.rtt = 0
+        self.last_rtt = 0
+
+    def update(self, host_sent, relay_received, relay_sent, host_received):
+
+        # NTP-style exchange: the time spent on the relay is removed from the round trip, and the offset assumes the
+        # network delay is the same in both directions
+        if not (host_sent and relay_received and relay_sent and host_received):
+            return False
+
+        rtt = (host_received - host_sent) - (relay_sent - relay_received)
+        offset = ((relay_received - host_sent) + (relay_sent - host_received)) // 2
+        self.samples.append((max(rtt, 0), offset))
+        self.last_rtt = max(rtt, 0)
+
+        # The exchange with the smallest round trip was delayed least by queueing, so its offset is the most accurate
+        self.rtt, self.offset = min(self.samples)
+        return True
+
+    def to_host(self, relay_time):
+        # Converts a relay timestamp to the host clock
+        return relay_time - self.offset
+
+    def breakdown(self, timestamps):
+
+        # Returns the seconds a frame spent in each stage, or None if the relay did not report the timestamps
+        t = timestamps
+        if not (t.host_sent and t.relay_received and t.relay_decoded and t.relay_sent and t.host_received):
+            return None
+
+        infer_start = t.infer_start if t.infer_start else t.relay_decoded
+        infer_end = t.infer_end if t.infer_end else infer_start
+        return {
+            "upload": max(self.to_host(t.relay_received) - t.host_sent, 0) / 1e9,
+            "decode": (t.relay_decoded - t.relay_received) / 1e9,
+            "queue": (infer_start - t.relay_decoded) / 1e9,
+            "infer": (infer_end - infer_start) / 1e9,
+            "reply": (t.relay_sent - infer_end) / 1e9,
+            "download": max(t.host_received - self.to_host(t.relay_sent), 0) / 1e9,
+        }
@@ -0,0 +1,178 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+CODEC_RAW, CODEC_JPEG, CODEC_PNG, CODEC_WEBP = 0, 1, 2, 3
+# Not a codec: the image is in a shared memory ring, and the message only carries a doorbell (see frame_ring.py)
+CODEC_SHM = 4
+
+
+class Codec:
+
+    codec_id = None
+    name = "base"
+
+    def __init__(self, quality=None):
+        self.quality = quality
+
+    def encode(self, img):
+        raise NotImplementedError
+
+    def __repr__(self):
+        if self.quality is None:
+            return self.name
+        return "{} q{}".format(self.name, self.quality)
+
+
+class RawCodec(Codec):
+
+    codec_id = CODEC_RAW
+    name = "raw"
+
+    def encode(self, img):
+        return np.ascontiguousarray(img, dtype=np.uint8).reshape(-1)
+
+
+class _OpenCVCodec(Codec):
+
+    extension = None
+    quality_flag = None
+
+    def encode(self, img):
+        params = [self.quality_flag, self.quality] if self.quality is not None else []
+        ret, data = cv2.imencode(self.extension, img, params)
+        if not ret:
+            raise ValueError("Codec: Failed to encode image as {}".format(self))
+        return data.reshape(-1)
+
+
+class JpegCodec(_OpenCVCodec):
+
+    codec_id = CODEC_JPEG
+    name = "jpeg"
+    extension = ".jpg"
+    quality_flag = cv2.IMWRITE_JPEG_QUALITY
+
+    def __init__(self, quality=95):
+        super().__init__(quality)
+
+
+class PngCodec(_OpenCVCodec):
+
+    # For PNG, the quality is the compression level (0-9)
+    codec_id = CODEC_PNG
+    name = "png"
+    extension = ".png"
+    quality_flag = cv2.IMWRITE_PNG_COMPRESSION
+
+    def __init__(self, quality=1):
+        super().__init__(quality)
+
+
+class WebpCodec(_OpenCVCodec):
+
+    codec_id = CODEC_WEBP
+    name = "webp"
+    extension = ".webp"
+    quality_flag = cv2.IMWRITE_WEBP_QUALITY
+
+    def __init__(self, quality=80):
+        super().__init__(quality)
+
+
+CODECS = {"raw": RawCodec, "jpeg": JpegCodec, "png": PngCodec, "webp": WebpCodec}
+
+
+def make_codec(name, quality=None):
+
+    if name not in CODECS:
+        raise ValueError("Codec: Unknown codec {}".format(name))
+
+    if quality is None or name == "raw":
+        return CODECS[name]()
+    return CODECS[name](quality)
+
+
+def decode_image(codec_id, data, height, width):
+
+    if codec_id == CODEC_RAW:
+        return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3).copy()
+    elif codec_id in (CODEC_JPEG, CODEC_PNG, CODEC_WEBP):
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    raise ValueError("Codec: Unknown codec id {}".format(codec_id))
+
+
+# Ordered from the most bytes on the wire to the fewest
+DEFAULT_LADDER = [RawCodec(), PngCodec(1), JpegCodec(95), JpegCodec(85), JpegCodec(75), JpegCodec(60),
+                  JpegCodec(45), JpegCodec(30)]
+
+
+class AdaptiveCodecController:
+
+    def __init__(self, host, conns, watch, target_latency, ladder=None, start=2, low_ratio=0.5, min_samples=10,
+                 verbose=False):
+
+        self.host = host
+        self.conns = conns
+        self.watch = watch
+        self.target_latency = target_latency
+        self.ladder = ladder if ladder else DEFAULT_LADDER
+        self.low_ratio = low_ratio
+        self.min_samples = min_samples
+        self.verbose = verbose
+
+        start = min(start, len(self.ladder) - 1)
+        self.levels = [start] * len(conns)
+        self.samples = [0] * len(conns)
+        # Connections that go through shared memory keep the raw codec, since their images are never on the wire
+        self.pinned = [host.uses_shared_memory(conn[0]) for conn in conns]
+        for conn, pinned in zip(conns, self.pinned):
+            if not pinned:
+                host.set_codec(conn[0], self.ladder[start])
+
+    def update(self, idx):
+
+        if self.pinned[idx]:
+            return
+
+        # Wait for the average to reflect the current setting before moving again
+        self.samples[idx] += 1
+        if self.samples[idx] < self.min_samples:
+            return
+
+        send_time = self.watch.send_ewma[idx]
+        level = self.levels[idx]
+        if send_time > self.target_latency and level < len(self.ladder) - 1:
+            level += 1
+        elif send_time < self.target_latency * self.low_ratio and level > 0:
+            level -= 1
+        else:
+            return
+
+        self.levels[idx] = level
+        self.samples[idx] = 0
+        self.host.set_codec(self.conns[idx][0], self.ladder[level])
+        if self.verbose:
+            print("Connection {}: send {}ms, switching to {}"
+                  .format(idx, round(send_time * 1000, 3), self.ladder[level]))
+
+    def report(self, name_map):
+        print("Codec:", " ".join(["{}: {}".format(name_map[i],
+                                                  "shared memory" if self.pinned[i] else self.ladder[level])
+                                  for i, level in enumerate(self.levels)]))
+
+
+class EncodePool:
+
+    def __init__(self, workers=None):
+        # Spawned rather than forked, since the host already runs socket threads when the pool starts
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, codec, img):
+        return self.executor.submit(codec.encode, img)
+
+    def close(self):
+        self.executor.shutdown()
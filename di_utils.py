@@ -1,3 +1,6 @@
+import socket
+from collections import OrderedDict
+
 import numpy as np
 import cv2
 
@@ -41,3 +44,175 @@ def draw_labels(img, proposals, labels=None):
         h = min(h, img_h - prop[1])
         roi = img[prop[1]:prop[1] + h, prop[0]:prop[0] + w, :]
         cv2.addWeighted(patch[0:h, 0:w, :], 0.5, roi, 0.5, 0, roi)
+
+
+class LabelRenderer:
+
+    def __init__(self, labels=None, conf_step=0.01, max_patches=4096):
+
+        if conf_step <= 0:
+            raise ValueError("LabelRenderer: Confidence step must be positive")
+        if max_patches < 1:
+            raise ValueError("LabelRenderer: Patch cache must hold at least 1 patch")
+
+        self.labels = labels
+        self.conf_step = conf_step
+        self.max_patches = max_patches
+        # (class, quantized confidence) -> rendered label patch, least recently used first
+        self.patches = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _patch(self, cls, step):
+
+        key = (cls, step)
+        patch = self.patches.get(key)
+        if patch is not None:
+            self.patches.move_to_end(key)
+            self.hits += 1
+            return patch
+
+        self.misses += 1
+        text = "{} {}".format(self.labels[cls] if self.labels else cls, round(step * self.conf_step, 2))
+
+        margin = 3
+        size = cv2.getTextSize(text, cv2.FONT_HERSHEY_PLAIN, 1.0, 1)
+        w = size[0][0] + margin * 2
+        h = size[0][1] + margin * 2
+
+        patch = np.empty((h, w, 3), dtype=np.uint8)
+        patch[...] = (232, 35, 244)
+        cv2.putText(patch, text, (margin + 1, h - margin - 2), cv2.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 255),
+                    lineType=cv2.LINE_8)
+        cv2.rectangle(patch, (0, 0), (w - 1, h - 1), (0, 0, 0), thickness=1)
+
+        if len(self.patches) >= self.max_patches:
+            self.patches.popitem(last=False)
+        self.patches[key] = patch
+        return patch
+
+    @staticmethod
+    def _columns(results):
+
+        # Accepts a protocol.RESULT_DTYPE array or rows of [x1, y1, x2, y2, class, confidence]
+        if isinstance(results, np.ndarray) and results.dtype.names:
+            boxes = np.stack([results["x1"], results["y1"], results["x2"], results["y2"]], axis=1)
+            return boxes.astype(np.float32), results["cls"].astype(np.int64), results["conf"]
+
+        rows = np.asarray(results, dtype=np.float64).reshape(-1, 6)
+        return rows[:, :4], rows[:, 4].astype(np.int64), rows[:, 5]
+
+    def draw(self, img, results, scale_x=1., scale_y=1., in_place=True):
+
+        # Returns the labeled image, which is img itself unless in_place is False
+        if not in_place:
+            img = np.copy(img)
+        if len(results) == 0:
+            return img
+
+        boxes, classes, confs = LabelRenderer._columns(results)
+        boxes = (boxes * np.array([scale_x, scale_y, scale_x, scale_y], dtype=boxes.dtype)).astype(np.int32)
+        steps = np.rint(confs / self.conf_step).astype(np.int64)
+
+        img_h, img_w, _ = img.shape
+        for (x1, y1, x2, y2), cls, step in zip(boxes.tolist(), classes.tolist(), steps.tolist()):
+            if x1 >= img_w or y1 >= img_h:
+                continue
+
+            cv2.rectangle(img, (x1, y1), (x2, y2), (232, 35, 244), 2)
+
+            patch = self._patch(cls, step)
+            h = min(patch.shape[0], img_h - y1)
+            w = min(patch.shape[1], img_w - x1)
+            roi = img[y1:y1 + h, x1:x1 + w, :]
+            cv2.addWeighted(patch[0:h, 0:w, :], 0.5, roi, 0.5, 0, roi)
+
+        return img
+
+
+class ReceiveBuffer:
+
+    def __init__(self, capacity=65536):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _reserve(self, size):
+        available = self.end - self.start
+
+        if size > len(self.buf):
+            buf = bytearray(max(size, len(self.buf) * 2))
+            view = memoryview(buf)
+            view[:available] = self.view[self.start:self.end]
+            self.view.release()
+            self.buf = buf
+            self.view = view
+        elif self.start + size > len(self.buf):
+            self.view[:available] = self.view[self.start:self.end]
+        else:
+            return
+
+        self.start = 0
+        self.end = available
+
+    def fill(self, sock, size):
+        if self.end - self.start >= size:
+            return True
+
+        self._reserve(size)
+
+        while self.end - self.start < size:
+            n = sock.recv_into(self.view[self.end:])
+            if n == 0:
+                return False
+            self.end += n
+
+        return True
+
+    def read(self, size):
+        view = self.view[self.start:self.start + size]
+        self.start += size
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return view
+
+
+# Largest number of buffers passed to one sendmsg call, the Linux IOV_MAX
+MAX_SEND_BUFFERS = 1024
+
+
+def send_buffers(sock, buffers):
+
+    # Sends the buffers back to back without joining them, resuming after partial writes
+    views = [memoryview(b).cast("B") for b in buffers]
+    views = [view for view in views if len(view)]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + MAX_SEND_BUFFERS])
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+def socket_options(no_delay=True, send_buffer=None, receive_buffer=None):
+    # Returns (level, option, value) tuples for apply_socket_options; buffer sizes are in bytes
+    options = []
+    if no_delay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if send_buffer:
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer))
+    if receive_buffer:
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer))
+    return options
+
+
+def apply_socket_options(sock, options):
+    for level, option, value in options:
+        sock.setsockopt(level, option, value)
@@ -0,0 +1,372 @@
+import asyncio
+import queue
+import threading
+import time
+
+from codec import RawCodec
+from scheduler import FirstReadyScheduler
+
+
+class Dispatcher:
+
+    def __init__(self, host, on_result, window=2, scheduler=None, on_lost=None, encode_pool=None, verbose=False,
+                 batch_size=1, batch_timeout=0.01):
+
+        if window < 1:
+            raise ValueError("Dispatcher: Window must be at least 1")
+        if batch_size < 1 or batch_size > window:
+            raise ValueError("Dispatcher: Batch size must be between 1 and the window")
+
+        self.host = host
+        self.on_result = on_result
+        self.on_lost = on_lost
+        self.encode_pool = encode_pool
+        self.window = window
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.scheduler = scheduler if scheduler else FirstReadyScheduler()
+        self.verbose = verbose
+
+        self.conns = list(host.get_connections())
+        n = len(self.conns)
+
+        # A frame holds a credit from submit() until its result arrives, so a queue never holds more than `window`
+        self.queues = [queue.Queue(maxsize=window) for _ in range(n)]
+        self.credits = [window] * n
+        self.credit_cond = threading.Condition()
+        self.alive = [True] * n
+
+        self.pending = [{} for _ in range(n)]
+        self.pending_lock = threading.Lock()
+
+        self.max_depths = [0] * n
+        self.threads = []
+        # Set by close(), after which connections are expected to end
+        self.closing = False
+
+    def start(self):
+
+        for idx in range(len(self.conns)):
+            for target in (self._send_loop, self._receive_loop):
+                t = threading.Thread(target=target, args=(idx,), daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def close(self):
+        self.closing = True
+        for q in self.queues:
+            q.put(None)
+
+    def _wait_for_credit(self):
+
+        while True:
+            if not any(self.alive):
+                raise RuntimeError("Dispatcher: All connections are closed")
+            candidates = [idx for idx, credit in enumerate(self.credits) if credit > 0 and self.alive[idx]]
+            if candidates:
+                return self.scheduler.select(candidates, [self.window - credit for credit in self.credits])
+            self.credit_cond.wait()
+
+    def submit(self, frame_id, frame):
+
+        with self.credit_cond:
+            idx = self._wait_for_credit()
+            self.credits[idx] -= 1
+
+            encoded = None
+            if self.encode_pool:
+                codec = self.host.get_codec(self.conns[idx][0])
+                encoded = (self.encode_pool.submit(codec, frame), codec.codec_id)
+
+            # Never blocks, and holding the lock keeps the frame from being queued on a connection that just closed
+            self.queues[idx].put((frame_id, frame, encoded))
+
+        self.max_depths[idx] = max(self.max_depths[idx], self.queues[idx].qsize())
+        return idx
+
+    def _next_batch(self, q):
+
+        # Returns up to batch_size queued frames, waiting at most batch_timeout for the batch to fill, and whether the
+        # queue was closed
+        item = q.get()
+        if item is None:
+            return [], True
+
+        items = [item]
+        deadline = time.time() + self.batch_timeout
+        while len(items) < self.batch_size:
+            try:
+                item = q.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return items, True
+            items.append(item)
+
+        return items, False
+
+    def _send(self, conn, items):
+
+        if len(items) == 1:
+            frame_id, frame, encoded = items[0]
+            if encoded:
+                # The queue is FIFO, so frames still go out in submission order
+                future, codec_id = encoded
+                h, w = frame.shape[:2]
+                self.host.send_encoded(conn, future.result(), codec_id, h, w, frame_id)
+            else:
+                self.host.send_image(conn, frame, frame_id)
+        elif self.encode_pool:
+            self.host.send_encoded_batch(conn, [(encoded[0].result(), encoded[1], frame.shape[0], frame.shape[1],
+                                                 frame_id) for frame_id, frame, encoded in items])
+        else:
+            self.host.send_batch(conn, [(frame_id, frame) for frame_id, frame, _ in items])
+
+    def _send_loop(self, idx):
+
+        conn = self.conns[idx][0]
+        q = self.queues[idx]
+
+        while True:
+
+            items, closed = self._next_batch(q)
+            if not items:
+                return
+
+            entries = self._register(idx, items)
+            try:
+                self._send(conn, items)
+            except OSError:
+                print("Connection {} broken".format(idx))
+                self._close_connection(idx)
+                return
+            self._sent(entries)
+
+            if self.verbose:
+                print("Sent frames: ", [item[0] for item in items])
+
+            if closed:
+                return
+
+    def _receive_loop(self, idx):
+
+        conn = self.conns[idx][0]
+
+        while True:
+
+            try:
+                res = self.host.get_frame_timing(conn)
+            except OSError:
+                # The host closed the connection under this thread
+                res = None
+            if not self._handle_result(idx, res):
+                return
+
+    def _register(self, idx, items):
+
+        # Registered before sending, since the result can arrive before the sender runs again
+        send_start = time.time()
+        entries = [[send_start, 0.] for _ in items]
+        with self.pending_lock:
+            for (frame_id, _, _), entry in zip(items, entries):
+                self.pending[idx][frame_id] = entry
+        return entries
+
+    def _sent(self, entries):
+        send_end = time.time()
+        with self.pending_lock:
+            for entry in entries:
+                entry[1] = send_end
+
+    def _handle_result(self, idx, res):
+
+        # Returns False if the connection broke
+        if res is None:
+            if not self.closing:
+                print("Connection {} broken".format(idx))
+            self._close_connection(idx)
+            return False
+
+        frame_id, result, timestamps = res
+        receive_time = time.time()
+        with self.pending_lock:
+            send_start, send_end = self.pending[idx].pop(frame_id)
+        if send_end == 0.:
+            # The result arrived before the send call returned, so the whole round trip counts as sending
+            send_end = receive_time
+
+        with self.credit_cond:
+            self.credits[idx] += 1
+            self.credit_cond.notify()
+
+        if result is None:
+            if self.on_lost:
+                self.on_lost(idx, frame_id)
+            return True
+
+        if self.verbose:
+            print("Got infer result for frame ", frame_id)
+
+        self.on_result(idx, frame_id, result, send_end - send_start, receive_time - send_end, timestamps)
+        return True
+
+    def _close_connection(self, idx):
+
+        with self.credit_cond:
+            self.alive[idx] = False
+            self.credit_cond.notify_all()
+
+            lost = []
+            while not self.queues[idx].empty():
+                item = self.queues[idx].get_nowait()
+                if item is not None:
+                    lost.append(item[0])
+
+        with self.pending_lock:
+            lost.extend(self.pending[idx].keys())
+            self.pending[idx].clear()
+
+        if self.on_lost:
+            for frame_id in lost:
+                self.on_lost(idx, frame_id)
+
+    def queue_depths(self):
+        return [q.qsize() for q in self.queues]
+
+    def in_flight(self):
+        with self.credit_cond:
+            return [self.window - credit for credit in self.credits]
+
+    def report(self, name_map):
+        depths = self.queue_depths()
+        in_flight = self.in_flight()
+        print("Queue depth:",
+              " ".join(["{}: {} (max {}, in flight {})".format(name_map[i], depths[i], self.max_depths[i], in_flight[i])
+                        for i in range(len(self.conns))]))
+
+
+class AsyncDispatcher(Dispatcher):
+
+    def __init__(self, host, on_result, window=2, scheduler=None, on_lost=None, encode_pool=None, verbose=False,
+                 batch_size=1, batch_timeout=0.01):
+
+        # host is an AsyncHost, whose event loop runs the send and receive loops of every connection as coroutines
+        super().__init__(host, on_result, window, scheduler, on_lost, encode_pool, verbose, batch_size, batch_timeout)
+        self.loop = host.loop
+        # Set from the submitting thread when a connection's queue gets a frame. Created by start() on the loop, since
+        # before Python 3.10 an event is bound to the loop of the thread that creates it
+        self.wakeups = []
+        self.tasks = []
+
+    async def _make_wakeups(self):
+        return [asyncio.Event() for _ in self.conns]
+
+    def start(self):
+        self.wakeups = self.host.run(self._make_wakeups())
+        for idx in range(len(self.conns)):
+            for target in (self._send_loop, self._receive_loop):
+                self.tasks.append(asyncio.run_coroutine_threadsafe(target(idx), self.loop))
+
+    def _wake(self, idx):
+        # The coroutine clears the event before its last look at the queue, so a set event already covers this frame
+        if not self.wakeups[idx].is_set():
+            self.loop.call_soon_threadsafe(self.wakeups[idx].set)
+
+    def submit(self, frame_id, frame):
+        idx = super().submit(frame_id, frame)
+        self._wake(idx)
+        return idx
+
+    def close(self):
+        super().close()
+        for idx in range(len(self.conns)):
+            self._wake(idx)
+
+    async def _next_item(self, idx, timeout=None):
+
+        q = self.queues[idx]
+        wakeup = self.wakeups[idx]
+        while True:
+            try:
+                return q.get_nowait()
+            except queue.Empty:
+                pass
+            wakeup.clear()
+            # A frame queued before the clear would not wake this coroutine again
+            try:
+                return q.get_nowait()
+            except queue.Empty:
+                pass
+            await asyncio.wait_for(wakeup.wait(), timeout)
+
+    async def _next_batch(self, idx):
+
+        item = await self._next_item(idx)
+        if item is None:
+            return [], True
+
+        items = [item]
+        deadline = time.time() + self.batch_timeout
+        while len(items) < self.batch_size:
+            try:
+                item = await self._next_item(idx, max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return items, True
+            items.append(item)
+
+        return items, False
+
+    async def _encode(self, conn, frame, encoded):
+
+        if encoded:
+            future, codec_id = encoded
+            return await asyncio.wrap_future(future), codec_id
+        codec = self.host.get_codec(conn)
+        if isinstance(codec, RawCodec):
+            return codec.encode(frame), codec.codec_id
+        # Compression would stall every other connection on the loop, so it runs on the loop's worker threads
+        return await self.loop.run_in_executor(None, codec.encode, frame), codec.codec_id
+
+    async def _send_loop(self, idx):
+
+        conn = self.conns[idx][0]
+
+        while True:
+
+            items, closed = await self._next_batch(idx)
+            if not items:
+                return
+
+            entries = self._register(idx, items)
+            try:
+                images = []
+                for frame_id, frame, encoded in items:
+                    data, codec_id = await self._encode(conn, frame, encoded)
+                    images.append((data, codec_id, frame.shape[0], frame.shape[1], frame_id))
+                await self.host.send_encoded_batch(conn, images)
+            except OSError:
+                print("Connection {} broken".format(idx))
+                self._close_connection(idx)
+                return
+            self._sent(entries)
+
+            if self.verbose:
+                print("Sent frames: ", [item[0] for item in items])
+
+            if closed:
+                return
+
+    async def _receive_loop(self, idx):
+
+        conn = self.conns[idx][0]
+
+        while True:
+
+            try:
+                res = await self.host.get_frame_timing(conn)
+            except OSError:
+                res = None
+            if not self._handle_result(idx, res):
+                return
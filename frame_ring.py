@@ -0,0 +1,140 @@
+import hmac
+import ipaddress
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import protocol
+from codec import CODEC_SHM
+
+SLOT_FREE, SLOT_FULL = 0, 1
+
+
+def _attach(name):
+    # Only the creator may unlink the segment, so the attaching process must not track it
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class FrameRing:
+
+    def __init__(self, slots=32, slot_size=300 * 300 * 3, name=None, nonce=None):
+
+        if slots < 1:
+            raise ValueError("FrameRing: Slots must be at least 1")
+        if slot_size < 1:
+            raise ValueError("FrameRing: Slot size must be at least 1")
+        if name is not None and (nonce is None or len(nonce) != protocol.SHM_NONCE_SIZE):
+            raise ValueError("FrameRing: Attaching requires the {} byte nonce of the ring"
+                             .format(protocol.SHM_NONCE_SIZE))
+
+        # A random nonce that proves the segment is this ring, one state byte per slot, padded to a cache line, and the
+        # slots
+        header = -(-(protocol.SHM_NONCE_SIZE + slots) // 64) * 64
+        size = header + slots * slot_size
+
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.nonce = os.urandom(protocol.SHM_NONCE_SIZE)
+            self.shm.buf[:protocol.SHM_NONCE_SIZE] = self.nonce
+        else:
+            self.shm = _attach(name)
+            if self.shm.size < size:
+                self.shm.close()
+                raise ValueError("FrameRing: Segment {} is smaller than {} slots of {} bytes"
+                                 .format(name, slots, slot_size))
+            # Checked before anything is written, so a segment that belongs to another process is left untouched
+            if not hmac.compare_digest(bytes(self.shm.buf[:protocol.SHM_NONCE_SIZE]), nonce):
+                self.shm.close()
+                raise ValueError("FrameRing: Segment {} does not hold the ring's nonce".format(name))
+            self.nonce = nonce
+
+        self.name = self.shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.states = np.ndarray((slots,), dtype=np.uint8, buffer=self.shm.buf, offset=protocol.SHM_NONCE_SIZE)
+        self.data = np.ndarray((slots, slot_size), dtype=np.uint8, buffer=self.shm.buf, offset=header)
+        if self.owner:
+            self.states[:] = SLOT_FREE
+        self.next = 0
+
+    def write(self, data):
+
+        # Copies data into a free slot and returns its index, or None if it does not fit or every slot is in use
+        size = len(data)
+        if size > self.slot_size:
+            return None
+
+        for i in range(self.slots):
+            slot = (self.next + i) % self.slots
+            if self.states[slot] == SLOT_FREE:
+                break
+        else:
+            return None
+
+        self.data[slot, :size] = np.frombuffer(data, dtype=np.uint8)
+        self.states[slot] = SLOT_FULL
+        self.next = (slot + 1) % self.slots
+        return slot
+
+    def message(self, data, codec_id):
+
+        # Returns the (data, codec_id) to send: a doorbell if the encoded image was placed in the ring, otherwise the
+        # image
+        slot = self.write(data)
+        if slot is None:
+            return data, codec_id
+        return np.frombuffer(protocol.pack_doorbell(slot, len(data), codec_id), dtype=np.uint8), CODEC_SHM
+
+    def read(self, slot, size):
+        # A read-only view of the slot, valid until the slot is released
+        view = self.data[slot, :size]
+        view.flags.writeable = False
+        return view
+
+    def release(self, slot):
+        self.states[slot] = SLOT_FREE
+
+    def close(self):
+        self.states = None
+        self.data = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A frame view is still in use; the mapping is released when the process exits
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def _is_loopback(address):
+    # address is a peer address as returned by getpeername
+    try:
+        ip = ipaddress.ip_address(address[0])
+    except (ValueError, TypeError, IndexError):
+        return False
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_loopback
+
+
+def attach_offered_ring(address, name, slots, slot_size, nonce):
+
+    # Returns the ring a relay at address offered in its hello, or None if the host should keep using the socket
+    if not _is_loopback(address):
+        # Any client can name a segment, so only relays on this machine may have the host write to one
+        print("Connection {} offered shared memory from another machine, using the socket".format(address))
+        return None
+    try:
+        ring = FrameRing(slots, slot_size, name, nonce)
+    except (OSError, ValueError) as e:
+        print("Shared memory {} is not available, using the socket: {}".format(name, e))
+        return None
+    print("Using shared memory {} for connection".format(name))
+    return ring
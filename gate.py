@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+
+
+class MotionGate:
+
+    def __init__(self, pixel_threshold=12, area_threshold=0.01, max_skip=30, size=(32, 32)):
+
+        if not 0 <= area_threshold <= 1:
+            raise ValueError("MotionGate: Area threshold must be between 0 and 1")
+        if max_skip < 0:
+            raise ValueError("MotionGate: Maximum skip must be at least 0")
+
+        # A cell of the downscaled frame has changed if its grey level moved by more than pixel_threshold, and the frame
+        # has changed if more than area_threshold of the cells did
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.max_skip = max_skip
+        self.size = size
+
+        # Downscaled copy of the last frame that was let through
+        self.reference = None
+        self.skipped = 0
+        self.passed = 0
+        self.gated = 0
+
+    def _thumbnail(self, frame):
+        # Area interpolation averages each cell, which also smooths out sensor noise
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def check(self, frame):
+
+        # Returns True if the frame should be inferred, or False if the detections of the last inferred frame still
+        # apply
+        thumbnail = self._thumbnail(frame)
+
+        if self.reference is not None and self.skipped < self.max_skip:
+            changed = np.count_nonzero(cv2.absdiff(thumbnail, self.reference) > self.pixel_threshold)
+            if changed <= self.area_threshold * thumbnail.size:
+                self.skipped += 1
+                self.gated += 1
+                return False
+
+        self.reference = thumbnail
+        self.skipped = 0
+        self.passed += 1
+        return True
+
+    def reset(self):
+        self.reference = None
+        self.skipped = 0
+
+    def report(self):
+        total = self.passed + self.gated
+        print("Motion gate: {} of {} frames inferred ({}% reused)"
+              .format(self.passed, total, round(self.gated / total * 100, 1) if total else 0.))
@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+
+
+class Histogram:
+
+    def __init__(self, window=None, slots=6, precision=7, max_value=1 << 40):
+
+        if precision < 1:
+            raise ValueError("Histogram: Precision must be at least 1 bit")
+        if window is not None and slots < 1:
+            raise ValueError("Histogram: Slots must be at least 1")
+
+        # Values below 2^precision get their own bucket; above that, each power of two is split into 2^(precision - 1)
+        # buckets, so the relative error is below 2^(1 - precision)
+        self.precision = precision
+        self.sub_count = 1 << precision
+        self.half = self.sub_count >> 1
+        self.max_value = max_value
+        self.num_buckets = self._index(max_value) + 1
+
+        self.window = window
+        self.slots = slots if window is not None else 1
+        self.slot_ns = int(window * 1e9 / slots) if window is not None else None
+        self.epoch = self._epoch()
+
+        self.counts = [[0] * self.num_buckets for _ in range(self.slots)]
+        self.totals = [0] * self.slots
+        self.sums = [0] * self.slots
+        self.maxes = [0] * self.slots
+        self.lock = threading.Lock()
+
+    def _index(self, value):
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.precision
+        return shift * self.half + (value >> shift)
+
+    def _value(self, index):
+        # Highest value that falls in the bucket
+        if index < self.sub_count:
+            return index
+        shift = (index - self.sub_count) // self.half + 1
+        top = index - shift * self.half
+        return ((top + 1) << shift) - 1
+
+    def _epoch(self):
+        if self.slot_ns is None:
+            return 0
+        return time.perf_counter_ns() // self.slot_ns
+
+    def _rotate(self, epoch):
+        # Clears the slots of the time slices that passed since the last sample
+        for e in range(max(self.epoch + 1, epoch - self.slots + 1), epoch + 1):
+            slot = e % self.slots
+            self.counts[slot] = [0] * self.num_buckets
+            self.totals[slot] = 0
+            self.sums[slot] = 0
+            self.maxes[slot] = 0
+        self.epoch = epoch
+
+    def record(self, value):
+
+        # Values are integers, normally nanoseconds from time.perf_counter_ns. _index is inlined to keep this cheap
+        if value < self.sub_count:
+            value = max(value, 0)
+            index = value
+        else:
+            if value > self.max_value:
+                value = self.max_value
+            shift = value.bit_length() - self.precision
+            index = shift * self.half + (value >> shift)
+
+        with self.lock:
+            if self.slot_ns is not None:
+                epoch = time.perf_counter_ns() // self.slot_ns
+                if epoch != self.epoch:
+                    self._rotate(epoch)
+                slot = self.epoch % self.slots
+            else:
+                slot = 0
+            self.counts[slot][index] += 1
+            self.totals[slot] += 1
+            self.sums[slot] += value
+            if value > self.maxes[slot]:
+                self.maxes[slot] = value
+
+    def record_seconds(self, seconds):
+        self.record(int(seconds * 1e9))
+
+    def _merged(self):
+        with self.lock:
+            if self.slot_ns is not None:
+                self._rotate(max(self._epoch(), self.epoch))
+            if self.slots == 1:
+                return list(self.counts[0]), self.totals[0], self.sums[0], self.maxes[0]
+            return [sum(c) for c in zip(*self.counts)], sum(self.totals), sum(self.sums), max(self.maxes)
+
+    @staticmethod
+    def _percentile(counts, total, maximum, p, value):
+        if total == 0:
+            return 0
+        target = max(1, -(-total * p // 100))
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= target:
+                return min(value(index), maximum)
+        return maximum
+
+    def percentile(self, p):
+        counts, total, _, maximum = self._merged()
+        return Histogram._percentile(counts, total, maximum, p, self._value)
+
+    def count(self):
+        return self._merged()[1]
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        # All times are in milliseconds, assuming the recorded values are nanoseconds
+        counts, total, total_sum, maximum = self._merged()
+        snap = {"count": total, "mean": total_sum / total / 1e6 if total else 0.}
+        for p in percentiles:
+            snap["p{}".format(p)] = Histogram._percentile(counts, total, maximum, p, self._value) / 1e6
+        snap["max"] = maximum / 1e6
+        return snap
+
+    def reset(self):
+        with self.lock:
+            for slot in range(self.slots):
+                self.counts[slot] = [0] * self.num_buckets
+                self.totals[slot] = 0
+                self.sums[slot] = 0
+                self.maxes[slot] = 0
+
+
+def format_snapshot(snap):
+    return "p50 {}ms p90 {}ms p99 {}ms max {}ms".format(
+        round(snap["p50"], 3), round(snap["p90"], 3), round(snap["p99"], 3), round(snap["max"], 3))
+
+
+def write_snapshot(snap, path):
+    with open(path, "w") as f:
+        json.dump(snap, f, indent=2)
@@ -2,21 +2,28 @@ import socket
 import threading
 import argparse
 import cv2
-import struct
-import numpy as np
 import time
 
 import di_utils
-
-ENCODING = "JPG"
+import protocol
+import tiling
+from clock import ClockEstimator
+from codec import CODECS, RawCodec, make_codec
 
 
 class Host:
 
-    def __init__(self, port=8080, verbose=False):
+    def __init__(self, port=8080, verbose=False, codec=None, num_connections=None, socket_options=None):
 
         self.verbose = verbose
+        self.codec = codec if codec else make_codec("jpeg")
+        self.codecs = {}
+        self.clocks = {}
+        self.rings = {}
+        self.socket_options = socket_options if socket_options is not None else di_utils.socket_options()
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Buffer sizes must be set before listening to take effect on the connections
+        di_utils.apply_socket_options(self.s, self.socket_options)
         self.s.bind(('', port))
         self.s.listen()
         self.close_new = False
@@ -24,83 +31,191 @@ class Host:
         self.conns = []
 
         self.buffers = {}
+        self.conn_cond = threading.Condition()
 
         t = threading.Thread(target=self._add_connections, daemon=True)
         t.start()
         self.first_rec_time = 0
 
-        input("Press enter to stop accepting connections and begin transmission\n")
+        if num_connections is None:
+            input("Press enter to stop accepting connections and begin transmission\n")
+        else:
+            with self.conn_cond:
+                while len(self.conns) < num_connections:
+                    self.conn_cond.wait()
         self.close_new = True
 
     def _add_connections(self):
         while not self.close_all:
-            res = self.s.accept()
+            try:
+                res = self.s.accept()
+            except OSError:
+                # The listening socket was closed
+                return
             if not self.close_new:
-                self.conns.append(res)
-                self.buffers[id(res[0])] = bytearray()
+                di_utils.apply_socket_options(res[0], self.socket_options)
+                self.buffers[id(res[0])] = di_utils.ReceiveBuffer()
+                self.clocks[id(res[0])] = ClockEstimator()
+                if not self._read_hello(res[0], res[1]):
+                    print("Connection {} did not complete the handshake".format(res))
+                    res[0].close()
+                    continue
+                with self.conn_cond:
+                    self.conns.append(res)
+                    self.conn_cond.notify_all()
                 print("Added a new connection, {}. {} connections total"
                       .format(res, len(self.conns)))
 
+    def _read_hello(self, conn, address, timeout=5):
+
+        buf = self.buffers[id(conn)]
+        conn.settimeout(timeout)
+        try:
+            if not buf.fill(conn, protocol.HELLO_HEADER.size):
+                return False
+            flags, name_length, slots, slot_size, nonce = protocol.unpack_hello_header(
+                buf.read(protocol.HELLO_HEADER.size))
+            if not buf.fill(conn, name_length):
+                return False
+            name = bytes(buf.read(name_length)).decode()
+        except (OSError, ValueError) as e:
+            print("Handshake failed: {}".format(e))
+            return False
+        conn.settimeout(None)
+
+        if flags & protocol.HELLO_FLAG_SHM:
+            # Imported here, so hosts without multiprocessing.shared_memory (before Python 3.8) still serve sockets
+            from frame_ring import attach_offered_ring
+            ring = attach_offered_ring(address, name, slots, slot_size, nonce)
+            if ring is not None:
+                self.rings[id(conn)] = ring
+                # The relay is on this machine, so images go uncompressed through shared memory
+                self.codecs[id(conn)] = RawCodec()
+        return True
+
     def _remove_connection(self, conn):
         self.conns.remove(conn)
 
     def close(self):
         self.close_new = True
+        self.close_all = True
+        # Shutting down first wakes any thread blocked on the socket, and lets the peer see the connection end
         for conn in self.conns:
+            try:
+                conn[0].shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             conn[0].close()
+        for ring in self.rings.values():
+            ring.close()
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.s.close()
 
     def get_infer_result(self, conn):
+        res = self.get_frame_result(conn)
+        if res is None:
+            return None
+        return res[1]
+
+    def get_frame_result(self, conn):
+        res = self.get_frame_timing(conn)
+        if res is None:
+            return None
+        return res[:2]
+
+    def get_frame_timing(self, conn):
 
-        results = []
         buf = self.buffers[id(conn)]
         if self.verbose:
             print("Starting retrieval of message")
 
-        if len(buf) == 0:
+        if not buf.fill(conn, protocol.RESULT_HEADER.size):
+            return None
 
-            buf = bytearray(conn.recv(4096))
-            if len(buf) == 0:
-                return None
+        received = time.time_ns()
+        flags, frame_id, num_results, timestamps = protocol.unpack_result_header(
+            buf.read(protocol.RESULT_HEADER.size))
+        timestamps = timestamps._replace(host_received=received)
+        self.clocks[id(conn)].update(timestamps.host_sent, timestamps.relay_received, timestamps.relay_sent, received)
 
-        num_results = buf[0]
+        self.first_rec_time = time.time()
+        if self.verbose:
+            print("Getting results for frame {} with {} props".format(frame_id, num_results))
 
-        if len(buf) == 1:
-            buf = bytearray()
-        else:
-            buf = buf[1:]
+        size = num_results * protocol.RESULT_DTYPE.itemsize
+        if not buf.fill(conn, size):
+            print("ERROR: Inference signal stopped mid-transmission")
+            return
+
+        results = protocol.unpack_results(buf.read(size), num_results)
+
+        if flags & protocol.RESULT_FLAG_DROPPED:
+            if self.verbose:
+                print("Frame {} was dropped by the relay".format(frame_id))
+            return frame_id, None, timestamps
 
-        self.first_rec_time = time.time()
         if self.verbose:
-            print("Getting results with {} props".format(num_results))
+            print("Got props {}".format(results))
+
+        return frame_id, results, timestamps
 
-        while num_results > 0:
+    def get_clock(self, conn):
+        return self.clocks[id(conn)]
 
-            while len(buf) >= 16:
-                result = struct.unpack("HHHHHf", buf[0:16])
-                results.append(result)
-                if len(buf) == 16:
-                    buf = bytearray()
-                else:
-                    buf = buf[16:]
-                num_results -= 1
-                if self.verbose:
-                    print("Got prop {}. {} props left"
-                          .format(result, num_results))
+    def set_codec(self, conn, codec):
+        self.codecs[id(conn)] = codec
 
-            if num_results > 0:
-                data = conn.recv(4096)
-                if data == b'':
-                    print("ERROR: Inference signal stopped mid-transmission")
-                    return
+    def get_codec(self, conn):
+        return self.codecs.get(id(conn), self.codec)
 
-                buf += data
+    def uses_shared_memory(self, conn):
+        return id(conn) in self.rings
 
-        return results
+    def send_image(self, conn, img, frame_id=0, encoded=None):
 
-    def send_image(self, conn, img):
-        data = cv2.imencode("." + ENCODING, img)[1].tostring()
-        conn.sendall(struct.pack("I", len(data)) + data)
+        # encoded is an optional dictionary kept by the caller while it sends the same image to several connections,
+        # so the image is only encoded once per codec
+        codec = self.get_codec(conn)
+        h, w = img.shape[:2]
+        if encoded is None:
+            data = codec.encode(img)
+        else:
+            key = (codec.codec_id, codec.quality)
+            if key not in encoded:
+                encoded[key] = codec.encode(img)
+            data = encoded[key]
+        self.send_encoded(conn, data, codec.codec_id, h, w, frame_id)
+
+    def send_encoded(self, conn, data, codec_id, height, width, frame_id=0):
+        self.send_encoded_batch(conn, [(data, codec_id, height, width, frame_id)])
+
+    def send_batch(self, conn, frames):
+        codec = self.get_codec(conn)
+        self.send_encoded_batch(conn, [(codec.encode(img), codec.codec_id, img.shape[0], img.shape[1], frame_id)
+                                       for frame_id, img in frames])
+
+    def send_encoded_batch(self, conn, images):
+
+        # images is a list of (data, codec_id, height, width, frame_id), sent as one message
+        if not 0 < len(images) <= protocol.MAX_BATCH:
+            raise ValueError("Host: Batch size must be between 1 and {}".format(protocol.MAX_BATCH))
+
+        # The header carries the send time and the current RTT estimate, which the relay reports as its latency
+        sent = time.time_ns()
+        rtt = self.clocks[id(conn)].rtt // 1000
+        ring = self.rings.get(id(conn))
+        # The headers and images are gathered by sendmsg, so the encoded images are never copied in user space
+        buffers = []
+        for i, (data, codec_id, height, width, frame_id) in enumerate(images):
+            if ring is not None:
+                data, codec_id = ring.message(data, codec_id)
+            buffers.append(protocol.pack_image_header(frame_id, codec_id, height, width, len(data), sent=sent,
+                                                      rtt=rtt, batch=len(images) if i == 0 else 0))
+            buffers.append(data)
+        di_utils.send_buffers(conn, buffers)
 
     def get_connections(self):
         return Host._ConnectionIterator(self)
@@ -126,17 +241,54 @@ class Host:
             return obj
 
 
+def _infer_tiled(host, img, tile_size, overlap):
+
+    ih, iw = img.shape[:-1]
+    assembler = tiling.TileAssembler(tiling.tile_grid(iw, ih, tile_size, overlap))
+    crops = tiling.crop_tiles(img, assembler.tiles)
+    conns = [conn[0] for conn in host.get_connections()]
+
+    # Every connection is sent its share of the tiles before any result is read, so the devices work in parallel
+    start = time.time()
+    shares = [list(range(i, len(crops), len(conns))) for i in range(len(conns))]
+    for conn, share in zip(conns, shares):
+        for tile in share:
+            host.send_image(conn, crops[tile], tile)
+
+    merged = None
+    for conn, share in zip(conns, shares):
+        pending = set(share)
+        while pending:
+            res = host.get_frame_result(conn)
+            # A closed connection loses the rest of its tiles
+            tile, result = res if res is not None else (min(pending), None)
+            pending.discard(tile)
+            done = assembler.put(tile, result)
+            if done is not None:
+                merged = done[1]
+
+    print("Tiled: {} tiles on {} connections in {}ms, {} objects"
+          .format(len(crops), len(conns), round((time.time() - start) * 1000, 3), 0 if merged is None else len(merged)))
+    return merged if merged is not None else []
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", "-i", help="File path to input image", required=True)
     parser.add_argument("--port", "-p", help="Listening port to use", default=8080, type=int)
     parser.add_argument("--labels", "-l", help="Path of labels file")
+    parser.add_argument("--codec", "-c", help="Image codec", default="jpeg", choices=list(CODECS))
+    parser.add_argument("--quality", "-q", help="Codec quality (compression level for png)", type=int)
+    parser.add_argument("--tile_size", "-t", help="Also infer the full-resolution image as overlapping tiles of this "
+                                                  "size, spread over all connections", type=int)
+    parser.add_argument("--tile_overlap", help="Overlap between tiles, as a fraction of the tile size", default=0.2,
+                        type=float)
     args = parser.parse_args()
 
-    host = Host(args.port)
+    host = Host(args.port, codec=make_codec(args.codec, args.quality))
 
-    if args.labels:
-        labels = di_utils.read_labels(args.labels)
+    labels = di_utils.read_labels(args.labels) if args.labels else None
+    renderer = di_utils.LabelRenderer(labels)
 
     img = cv2.imread(args.input)
     ih, iw = img.shape[:-1]
@@ -145,9 +297,11 @@ def main():
     else:
         frame = img
 
+    # Connections with the same codec share one encoded image
+    encoded = {}
     for idx, conn in enumerate(host.get_connections()):
         send_start = time.time()
-        host.send_image(conn[0], frame)
+        host.send_image(conn[0], frame, encoded=encoded)
         send_end = time.time()
         result = host.get_infer_result(conn[0])
         get_end = time.time()
@@ -155,23 +309,15 @@ def main():
               .format(idx, round((send_end - send_start) * 1000, 3), round((host.first_rec_time - send_end) * 1000, 3),
                       round((get_end - host.first_rec_time) * 1000, 3), round((get_end - send_start) * 1000, 3)))
 
-        labeled_img = np.copy(img)
-
-        result = [((int(x1 * iw / 300),
-                    int(y1 * ih / 300),
-                    int(x2 * iw / 300),
-                    int(y2 * ih / 300), cls, conf)) for (x1, y1, x2, y2, cls, conf) in result]
-
-        if args.labels:
-            di_utils.draw_labels(labeled_img, result, labels=labels)
-        else:
-            di_utils.draw_labels(labeled_img, result)
+        # The same image is labeled for every connection, so each one draws on a copy
+        labeled_img = renderer.draw(img, result, iw / 300, ih / 300, in_place=False)
         cv2.imwrite("out/out{}.jpg".format(idx), labeled_img)
 
-    while True:
-        pass  # The program needs to stay alive to allow for TCP ping measurement
+    if args.tile_size:
+        labeled_img = renderer.draw(img, _infer_tiled(host, img, args.tile_size, args.tile_overlap), in_place=False)
+        cv2.imwrite("out/tiled.jpg", labeled_img)
 
-    sp.close()
+    host.close()
 
 
 if __name__ == '__main__':
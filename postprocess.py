@@ -0,0 +1,22 @@
+import numpy as np
+
+import protocol
+
+
+def ssd_postprocess(output, width, height, threshold=0.5, skip_classes=()):
+
+    # Rows of [image_id, class, confidence, x1, y1, x2, y2] with normalized coordinates
+    dets = np.asarray(output, dtype=np.float32).reshape(-1, 7)
+
+    # An image_id of -1 marks the end of the valid detections
+    keep = (dets[:, 2] >= threshold) & (dets[:, 0] >= 0)
+    if len(skip_classes):
+        keep &= ~np.isin(dets[:, 1], skip_classes)
+    dets = dets[keep]
+
+    results = np.empty(len(dets), dtype=protocol.RESULT_DTYPE)
+    boxes = np.clip(dets[:, 3:7] * np.array([width, height, width, height], dtype=np.float32), 0, 0xFFFF)
+    results["x1"], results["y1"], results["x2"], results["y2"] = boxes.T
+    results["cls"] = dets[:, 1]
+    results["conf"] = dets[:, 2]
+    return results
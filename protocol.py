@@ -0,0 +1,116 @@
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+PROTOCOL_VERSION = 6
+
+# Largest number of images in one batch message
+MAX_BATCH = 255
+
+# Image message: header followed by `length` bytes of encoded image
+# version, flags, codec, batch, frame_id, height, width, length, host send time (ns), host RTT estimate (us)
+# The first image of a batch has `batch` set to the number of images in the batch, which follow it back to back
+IMAGE_HEADER = struct.Struct("<BBBBIHHIQI")
+
+# Hello message, sent once by the relay after connecting: header followed by `name_length` bytes of shared memory name
+# version, flags, name_length, slots, slot_size, nonce written at the start of the ring by the relay
+HELLO_HEADER = struct.Struct("<BBHII16s")
+SHM_NONCE_SIZE = 16
+
+# The relay created a shared memory frame ring, and the host may place images in it
+HELLO_FLAG_SHM = 0x01
+
+# Payload of an image message with the codec.CODEC_SHM codec: the image is in the shared memory ring
+# slot, length, codec of the image in the slot
+SHM_DOORBELL = struct.Struct("<IIB")
+
+# Result message: header followed by `count` packed records
+# version, flags, reserved, frame_id, count, then the timestamps below (ns) except host_received
+RESULT_HEADER = struct.Struct("<BBHIIQQQQQQ")
+
+# host_sent is in the host clock and echoed by the relay; the relay fields are in the relay clock, and are 0 when
+# unknown; host_received is filled in by the host
+FrameTimestamps = namedtuple("FrameTimestamps", ["host_sent", "relay_received", "relay_decoded", "infer_start",
+                                                 "infer_end", "relay_sent", "host_received"])
+
+# The relay dropped the frame without inferring it
+RESULT_FLAG_DROPPED = 0x01
+
+RESULT_DTYPE = np.dtype([("x1", "<u2"), ("y1", "<u2"), ("x2", "<u2"), ("y2", "<u2"),
+                         ("cls", "<u2"), ("conf", "<f4")])
+
+
+def _check_version(version):
+    if version != PROTOCOL_VERSION:
+        raise ValueError("protocol: Unsupported message version {} (expected {})"
+                         .format(version, PROTOCOL_VERSION))
+
+
+def pack_image_header(frame_id, codec_id, height, width, length, flags=0, sent=0, rtt=0, batch=1):
+    return IMAGE_HEADER.pack(PROTOCOL_VERSION, flags, codec_id, batch, frame_id, height, width, length, sent,
+                             min(rtt, 0xFFFFFFFF))
+
+
+def unpack_image_header(data):
+    version, flags, codec_id, batch, frame_id, height, width, length, sent, rtt = IMAGE_HEADER.unpack(data)
+    _check_version(version)
+    return flags, frame_id, codec_id, height, width, length, sent, rtt, max(batch, 1)
+
+
+def pack_hello(shm_name=None, slots=0, slot_size=0, nonce=b""):
+    name = shm_name.encode() if shm_name else b""
+    return HELLO_HEADER.pack(PROTOCOL_VERSION, HELLO_FLAG_SHM if shm_name else 0, len(name), slots, slot_size,
+                             nonce) + name
+
+
+def unpack_hello_header(data):
+    # The name follows the header, name_length bytes long
+    version, flags, name_length, slots, slot_size, nonce = HELLO_HEADER.unpack(data)
+    _check_version(version)
+    return flags, name_length, slots, slot_size, nonce
+
+
+def pack_doorbell(slot, length, codec_id):
+    return SHM_DOORBELL.pack(slot, length, codec_id)
+
+
+def unpack_doorbell(data):
+    return SHM_DOORBELL.unpack(data)
+
+
+def to_result_array(results):
+
+    if isinstance(results, np.ndarray) and results.dtype == RESULT_DTYPE:
+        return results
+
+    records = np.empty(len(results), dtype=RESULT_DTYPE)
+    if len(results) == 0:
+        return records
+
+    boxes = np.clip(np.array([result[0] for result in results], dtype=np.int64).reshape(-1, 4), 0, 0xFFFF)
+    records["x1"], records["y1"], records["x2"], records["y2"] = boxes.T
+    records["cls"] = [result[1] for result in results]
+    records["conf"] = [result[2] for result in results]
+    return records
+
+
+def pack_results(results, frame_id, flags=0, timestamps=(0, 0, 0, 0, 0, 0)):
+
+    records = to_result_array(results)
+
+    buf = bytearray(RESULT_HEADER.size + records.nbytes)
+    RESULT_HEADER.pack_into(buf, 0, PROTOCOL_VERSION, flags, 0, frame_id, len(records), *timestamps[:6])
+    np.frombuffer(buf, dtype=RESULT_DTYPE, offset=RESULT_HEADER.size)[...] = records
+    return buf
+
+
+def unpack_result_header(data):
+    version, flags, _, frame_id, count, *timestamps = RESULT_HEADER.unpack(data)
+    _check_version(version)
+    return flags, frame_id, count, FrameTimestamps(*timestamps, 0)
+
+
+def unpack_results(data, count):
+    # Copy so the records outlive the receive buffer they were read from
+    return np.frombuffer(data, dtype=RESULT_DTYPE, count=count).copy()
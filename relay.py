@@ -1,15 +1,23 @@
 import argparse
 import socket
 import threading
-import struct
+import time
+from collections import deque
 
-import numpy as np
 import cv2
 
+import di_utils
+import protocol
+from codec import CODEC_RAW, CODEC_SHM, decode_image
+
 
 class Relay:
 
-    def __init__(self, ip, verbose=False):
+    def __init__(self, ip, verbose=False, capacity=16, latest_only=False, connect_timeout=0, shared_memory=False,
+                 shm_slots=32, shm_slot_size=300 * 300 * 3, socket_options=None):
+
+        if capacity < 1:
+            raise ValueError("Relay: Capacity must be at least 1")
 
         self.verbose = verbose
         s = ip.split(':')
@@ -20,87 +28,222 @@ class Relay:
             self.ip = s[0]
             self.port = 8080
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.ip, self.port))
-        self.images = []
+        self.socket = self._connect(connect_timeout)
+        # Results are small, and would otherwise wait for the host to acknowledge the previous one
+        di_utils.apply_socket_options(self.socket, socket_options if socket_options is not None
+                                      else di_utils.socket_options())
+
+        # A host on the same machine places images in the ring instead of sending them; one on another machine cannot
+        # open it and keeps using the socket
+        self.ring = None
+        if shared_memory:
+            # Imported here, so relays without multiprocessing.shared_memory (before Python 3.8) can still use sockets
+            from frame_ring import FrameRing
+            self.ring = FrameRing(shm_slots, shm_slot_size)
+        # Frame id -> ring slot holding the frame, released once the frame is answered
+        self.slots = {}
+        self.socket.sendall(protocol.pack_hello(self.ring.name, shm_slots, shm_slot_size, self.ring.nonce) if self.ring
+                            else protocol.pack_hello())
+        self.capacity = capacity
+        self.latest_only = latest_only
+        self.images = deque()
+        self.pending_ids = deque()
         self.stop = False
+        self.dropped = 0
+        # In-band round trip time to the host, in seconds, as estimated by the host
+        self.rtt = 0.
 
-        self.buffer_lock = threading.Lock()
+        # Frame id -> [host_sent, relay_received, relay_decoded, infer_start, infer_end], sent back with the results
+        self.timestamps = {}
+
+        self.buffer_cond = threading.Condition()
+        self.send_lock = threading.Lock()
 
         self.t = threading.Thread(target=self._store_images, daemon=True)
         self.t.start()
 
-    def _store_images(self):
+    def _connect(self, timeout):
+        # Retries until the host is listening, so clients can be started before the host
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return socket.create_connection((self.ip, self.port))
+            except ConnectionRefusedError:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+    def _read_image(self, buf):
+
+        # Returns (frame_id, img, batch), or None once the connection is closed
+        if not buf.fill(self.socket, protocol.IMAGE_HEADER.size):
+            return None
+
+        _, frame_id, codec_id, height, width, size, host_sent, rtt, batch = protocol.unpack_image_header(
+            buf.read(protocol.IMAGE_HEADER.size))
+        if rtt:
+            self.rtt = rtt / 1e6
 
-        buf = bytearray()
-        if self.stop:
+        print("Receiving image {} of size {}".format(frame_id, size))
+
+        if not buf.fill(self.socket, size):
             return None
 
-        while not self.stop:
+        received = time.time_ns()
+        data = buf.read(size)
+        if codec_id == CODEC_SHM:
+            img = self._read_slot(frame_id, data, height, width)
+        else:
+            img = decode_image(codec_id, data, height, width)
+        self.timestamps[frame_id] = [host_sent, received, time.time_ns(), 0, 0]
+        return frame_id, img, batch
 
-            # Initial phase to get size
-            while len(buf) < 4 and not self.stop:
-                data = self.socket.recv(4096)
-                if not data:
-                    print("Source connection closed")
-                    self.stop = True
-                    return
-                buf += data
+    def _read_slot(self, frame_id, doorbell, height, width):
 
-            remaining = struct.unpack("I", buf[0:4])[0]
-            buf = buf[4:]
-            remaining -= len(buf)
+        slot, size, codec_id = protocol.unpack_doorbell(doorbell)
+        if self.ring is None:
+            raise ValueError("Relay: Received a shared memory image without a shared memory ring")
 
-            print("Receiving image of size ", remaining)
+        data = self.ring.read(slot, size)
+        if codec_id == CODEC_RAW:
+            # Used in place, and released when the frame is answered
+            self.slots[frame_id] = slot
+            return data.reshape(height, width, 3)
 
-            while remaining > 0:
-                data = self.socket.recv(remaining)
-                if not data:
-                    print("Source connection closed")
-                    self.stop = True
-                    return
-                buf += data
-                remaining -= len(data)
+        img = decode_image(codec_id, data, height, width)
+        self.ring.release(slot)
+        return img
 
-            if remaining < 0:
-                img = bytes(buf[:remaining])
-                buf = buf[remaining:]
-            else:
-                img = bytes(buf)
-                buf = bytearray()
+    def _release(self, frame_id):
+        slot = self.slots.pop(frame_id, None)
+        if slot is not None:
+            self.ring.release(slot)
 
-            img = cv2.imdecode(np.fromstring(img, dtype=np.uint8), cv2.IMREAD_COLOR)
+    def _store_images(self):
 
-            with self.buffer_lock:
-                self.images.append(img)
+        buf = di_utils.ReceiveBuffer()
 
-    def get_image(self):
+        while not self.stop:
+
+            image = self._read_image(buf)
+            if image is None:
+                self._close_source()
+                return
+
+            # The rest of a batch follows its first image, and the whole batch is stored at once
+            frame_id, img, batch = image
+            frames = [(frame_id, img)]
+            for _ in range(batch - 1):
+                image = self._read_image(buf)
+                if image is None:
+                    self._close_source()
+                    return
+                frames.append(image[:2])
+
+            stale = []
+            with self.buffer_cond:
+                if self.latest_only:
+                    while self.images and len(self.images) + len(frames) > self.capacity:
+                        stale.append(self.images.popleft())
+                        self.dropped += 1
+                else:
+                    while len(self.images) >= self.capacity and not self.stop:
+                        self.buffer_cond.wait()
+                self.images.extend(frames)
+                self.buffer_cond.notify_all()
+
+            for frame in stale:
+                if self.verbose:
+                    print("Dropped stale frame ", frame[0])
+                # Tell the host the frame will never be answered
+                self._send(protocol.pack_results([], frame[0], protocol.RESULT_FLAG_DROPPED,
+                                                 self._pop_timestamps(frame[0])))
+                self._release(frame[0])
+
+    def _close_source(self):
+        print("Source connection closed")
+        with self.buffer_cond:
+            self.stop = True
+            self.buffer_cond.notify_all()
+
+    def get_frame(self):
 
         if self.verbose:
             print("Waiting to grab image")
-        while not self.images:
+
+        with self.buffer_cond:
+            while not self.images and not self.stop:
+                self.buffer_cond.wait()
+
+            if self.stop:
+                return None
+
+            frame = self.images.popleft()
+            self.buffer_cond.notify_all()
+            return frame
+
+    def get_frames(self, max_count):
+
+        # Waits for at least one frame, then returns up to max_count frames without waiting for more
+        with self.buffer_cond:
+            while not self.images and not self.stop:
+                self.buffer_cond.wait()
+
             if self.stop:
-                break
+                return None
 
-        if self.stop:
+            frames = [self.images.popleft() for _ in range(min(max_count, len(self.images)))]
+            self.buffer_cond.notify_all()
+            return frames
+
+    def get_image(self):
+
+        frame = self.get_frame()
+        if frame is None:
             return None
 
-        with self.buffer_lock:
-            return self.images.pop(0)
+        self.pending_ids.append(frame[0])
+        return frame[1]
+
+    def send_results(self, results, frame_id=None):
+
+        if frame_id is None:
+            frame_id = self.pending_ids.popleft()
+
+        self._send(protocol.pack_results(results, frame_id, timestamps=self._pop_timestamps(frame_id)))
+        self._release(frame_id)
+
+    def send_batch_results(self, batch):
+        # batch is a list of (frame_id, results), sent as one message
+        message = bytearray()
+        for frame_id, results in batch:
+            message += protocol.pack_results(results, frame_id, timestamps=self._pop_timestamps(frame_id))
+        self._send(message)
+        for frame_id, _ in batch:
+            self._release(frame_id)
 
-    def send_results(self, results):
+    def mark_infer(self, frame_id, start, end):
+        # Inference start and end times of a frame, from time.time_ns, reported to the host with the results
+        timestamps = self.timestamps.get(frame_id)
+        if timestamps is not None:
+            timestamps[3] = start
+            timestamps[4] = end
 
-        self.socket.sendall(struct.pack("B", len(results)))
+    def _pop_timestamps(self, frame_id):
+        timestamps = self.timestamps.pop(frame_id, [0, 0, 0, 0, 0])
+        return timestamps + [time.time_ns()]
 
-        for result in results:
-            # TODO: optimize by removing padding (is 16, should be 14)
-            data = struct.pack("HHHHHf",
-                               result[0][0], result[0][1], result[0][2], result[0][3], result[1], result[2])
+    def _send(self, data):
+        with self.send_lock:
             self.socket.sendall(data)
 
     def close(self):
-        self.stop = True
+        with self.buffer_cond:
+            self.stop = True
+            self.buffer_cond.notify_all()
         self.t.join()
+        if self.ring is not None:
+            self.ring.close()
 
 
 # Class unit test
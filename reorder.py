@@ -0,0 +1,90 @@
+import heapq
+import threading
+import time
+
+
+class ReorderBuffer:
+
+    def __init__(self, capacity=64, max_delay=None):
+
+        if capacity < 1:
+            raise ValueError("ReorderBuffer: Capacity must be at least 1")
+
+        self.capacity = capacity
+        self.max_delay = max_delay
+
+        self.heap = []
+        self.cond = threading.Condition()
+        self.next_frame = 0
+        self.final_frame = None
+        self.lost = set()
+        self.waiting_since = None
+
+        self.skipped = 0
+        self.late = 0
+
+    def reserve(self, frame_num):
+        # Blocks the producer while the frame would be too far ahead of the consumer
+        with self.cond:
+            while frame_num >= self.next_frame + self.capacity:
+                self.cond.wait()
+
+    def put(self, frame_num, item):
+        with self.cond:
+            if frame_num < self.next_frame:
+                self.late += 1
+                return False
+            heapq.heappush(self.heap, (frame_num, item))
+            self.cond.notify_all()
+            return True
+
+    def mark_lost(self, frame_num):
+        with self.cond:
+            self.lost.add(frame_num)
+            self.cond.notify_all()
+
+    def finish(self, num_frames):
+        with self.cond:
+            self.final_frame = num_frames
+            self.cond.notify_all()
+
+    def _advance(self):
+        self.next_frame += 1
+        self.waiting_since = None
+        self.cond.notify_all()
+
+    def get(self):
+
+        with self.cond:
+            while True:
+
+                if self.final_frame is not None and self.next_frame >= self.final_frame:
+                    return None
+
+                if self.heap and self.heap[0][0] == self.next_frame:
+                    frame_num, item = heapq.heappop(self.heap)
+                    self._advance()
+                    return frame_num, item
+
+                timeout = None
+                skip = self.next_frame in self.lost
+                if not skip and self.max_delay is not None and self.heap:
+                    # Later frames are ready, so the next frame is late
+                    now = time.time()
+                    if self.waiting_since is None:
+                        self.waiting_since = now
+                    timeout = self.waiting_since + self.max_delay - now
+                    skip = timeout <= 0
+
+                if skip:
+                    frame_num = self.next_frame
+                    self.lost.discard(frame_num)
+                    self.skipped += 1
+                    self._advance()
+                    return frame_num, None
+
+                self.cond.wait(timeout)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.heap)
@@ -0,0 +1,117 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+CACHE_MODES = ("exact", "perceptual")
+# Memory taken by an entry besides its detections: the key, the dictionary slot and the array object
+ENTRY_OVERHEAD = 256
+
+
+class ResultCache:
+
+    def __init__(self, mode="exact", max_bytes=4 * 1024 * 1024, hash_size=8, max_distance=0):
+
+        if mode not in CACHE_MODES:
+            raise ValueError("ResultCache: Unknown mode {}, expected one of {}".format(mode, ", ".join(CACHE_MODES)))
+        if max_bytes < ENTRY_OVERHEAD:
+            raise ValueError("ResultCache: Maximum size must be at least {} bytes".format(ENTRY_OVERHEAD))
+        if hash_size < 2:
+            raise ValueError("ResultCache: Hash size must be at least 2")
+        if not 0 <= max_distance < hash_size * hash_size:
+            raise ValueError("ResultCache: Maximum distance must be at least 0 and less than the hash length")
+
+        # Exact keys hash every byte of the frame, so only byte-identical frames share detections. Perceptual keys are
+        # a difference hash of a hash_size x hash_size thumbnail, and frames whose hashes differ in at most max_distance
+        # bits share detections
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hash_size = hash_size
+        self.max_distance = max_distance
+
+        # Least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        # Bits of every perceptual key, one row per key, rebuilt after the keys change
+        self.bits = None
+        self.bit_keys = None
+
+    def key(self, frame):
+
+        if self.mode == "exact":
+            frame = np.ascontiguousarray(frame)
+            digest = hashlib.blake2b(frame.data, digest_size=16)
+            # Frames of different sizes may hold the same bytes
+            digest.update(repr(frame.shape).encode())
+            return digest.digest()
+
+        # Whether each cell of the thumbnail is brighter than its right neighbor, which survives noise and re-encoding
+        small = cv2.resize(frame, (self.hash_size + 1, self.hash_size), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+
+    def _nearest(self, key):
+
+        if not self.entries:
+            return None
+        if self.bits is None:
+            self.bit_keys = list(self.entries)
+            self.bits = np.unpackbits(np.frombuffer(b"".join(self.bit_keys), dtype=np.uint8)
+                                      .reshape(len(self.bit_keys), -1), axis=1)
+
+        distances = np.count_nonzero(self.bits != np.unpackbits(np.frombuffer(key, dtype=np.uint8)), axis=1)
+        best = int(np.argmin(distances))
+        return self.bit_keys[best] if distances[best] <= self.max_distance else None
+
+    def get(self, key):
+
+        # Returns the cached detections as a read-only protocol.RESULT_DTYPE array, or None
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None and self.max_distance > 0:
+                key = self._nearest(key)
+                if key is not None:
+                    result = self.entries[key]
+            if result is not None:
+                self.entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+
+        result = result.copy()
+        result.flags.writeable = False
+        size = result.nbytes + ENTRY_OVERHEAD
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes + ENTRY_OVERHEAD
+            self.bits = None
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = result
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes + ENTRY_OVERHEAD
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.bits = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def report(self):
+        print("Result cache: {} entries in {} KB of {} KB, {} evicted".format(
+            len(self.entries), round(self.size / 1024, 1), round(self.max_bytes / 1024, 1), self.evictions))
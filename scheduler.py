@@ -0,0 +1,57 @@
+class Scheduler:
+
+    name = "base"
+
+    def select(self, candidates, in_flight):
+        raise NotImplementedError
+
+
+class FirstReadyScheduler(Scheduler):
+
+    name = "first"
+
+    def select(self, candidates, in_flight):
+        return candidates[0]
+
+
+class RoundRobinScheduler(Scheduler):
+
+    name = "round_robin"
+
+    def __init__(self):
+        self.next = 0
+
+    def select(self, candidates, in_flight):
+        # First candidate at or after the device following the last pick, wrapping around
+        idx = min(candidates, key=lambda c: (c < self.next, c))
+        self.next = idx + 1
+        return idx
+
+
+class WeightedScheduler(Scheduler):
+
+    name = "weighted"
+
+    def __init__(self, watch):
+        self.watch = watch
+
+    def select(self, candidates, in_flight):
+        # Pick the device expected to finish the new frame soonest, given the frames it already has in flight.
+        # Devices without measurements score 0, so every device is tried before the estimates take over
+        return min(candidates,
+                   key=lambda c: (in_flight[c] + 1) * (self.watch.send_ewma[c] + self.watch.get_ewma[c]))
+
+
+SCHEDULERS = ["first", "round_robin", "weighted"]
+
+
+def make_scheduler(name, watch):
+
+    if name == "first":
+        return FirstReadyScheduler()
+    elif name == "round_robin":
+        return RoundRobinScheduler()
+    elif name == "weighted":
+        return WeightedScheduler(watch)
+
+    raise ValueError("Scheduler: Unknown policy {}".format(name))
@@ -1,40 +1,61 @@
+import threading
 import time
 
+from histogram import Histogram, format_snapshot, write_snapshot
+
 class Stopwatch:
 
     MODE_PREPROCESS = 0
     MODE_INFER = 1
     MODE_POSTPROCESS = 2
 
-    def __init__(self, report_interval=10):
+    STAGE_NAMES = ["preprocessing", "inference", "postprocessing"]
+
+    def __init__(self, report_interval=10, window=None):
         self.report_interval = report_interval
         self.numread = 0
         self.wall_times = [0., 0., 0.]
         self.clock_times = [0., 0., 0.]
         self.recents_w = [0., 0., 0.]
         self.recents_c = [0., 0., 0.]
+        self.busy = [0., 0., 0.]
         self.last_report = -1000
+        self.first_start = None
+        self.lock = threading.Lock()
+        self.histograms = [Histogram(window) for _ in range(3)]
 
         self.start_c = 0.
-        self.start_w = 0.
+        self.start_w = 0
 
     def start(self):
-        self.start_w = time.time()
+        self.start_w = time.perf_counter_ns()
         self.start_c = time.process_time()
+        if self.first_start is None:
+            self.first_start = time.time()
 
     def stop(self, mode):
+        self.record(mode, (time.perf_counter_ns() - self.start_w) / 1e9, time.process_time() - self.start_c)
+
+    def record(self, mode, wall, clock=0.):
 
         if mode not in [0, 1, 2]:
             raise ValueError("Stopwatch: Bad watch mode")
 
-        self.recents_c[mode] = time.process_time() - self.start_c
-        self.recents_w[mode] = time.time() - self.start_w
+        self.histograms[mode].record_seconds(wall)
+
+        with self.lock:
+            if self.first_start is None:
+                self.first_start = time.time() - wall
 
-        self.wall_times[mode] = self.wall_times[mode] + (self.recents_w[mode] - self.wall_times[mode]) / (self.numread + 1)
-        self.clock_times[mode] = self.clock_times[mode] + (self.recents_c[mode] - self.clock_times[mode]) / (self.numread + 1)
+            self.recents_c[mode] = clock
+            self.recents_w[mode] = wall
+            self.busy[mode] += wall
 
-        if mode == Stopwatch.MODE_POSTPROCESS:
-            self.numread += 1
+            self.wall_times[mode] = self.wall_times[mode] + (self.recents_w[mode] - self.wall_times[mode]) / (self.numread + 1)
+            self.clock_times[mode] = self.clock_times[mode] + (self.recents_c[mode] - self.clock_times[mode]) / (self.numread + 1)
+
+            if mode == Stopwatch.MODE_POSTPROCESS:
+                self.numread += 1
 
     def report(self, force=False):
 
@@ -47,6 +68,19 @@ class Stopwatch:
                 round(self.clock_times[1] * 1000, 3), round(self.recents_c[1] * 1000, 3), round(self.wall_times[1] * 1000, 3), round(self.recents_w[1] * 1000, 3)))
             print("Average time of postprocessing - CPU: {}ms (recent: {}ms), wall: {}ms (recent: {}ms)".format(
                 round(self.clock_times[2] * 1000, 3), round(self.recents_c[2] * 1000, 3), round(self.wall_times[2] * 1000, 3), round(self.recents_w[2] * 1000, 3)))
+            if self.first_start is not None:
+                elapsed = time.time() - self.first_start
+                print("Throughput: {} FPS".format(round(self.numread / elapsed, 3)))
+                print("Stage occupancy - preprocessing: {}%, inference: {}%, postprocessing: {}%".format(
+                    *[round(busy * 100 / elapsed, 2) for busy in self.busy]))
+            for name, histogram in zip(Stopwatch.STAGE_NAMES, self.histograms):
+                print("Wall time of {} - {}".format(name, format_snapshot(histogram.snapshot())))
             return True
         else:
             return False
+
+    def snapshot(self):
+        return {name: histogram.snapshot() for name, histogram in zip(Stopwatch.STAGE_NAMES, self.histograms)}
+
+    def export(self, path):
+        write_snapshot(self.snapshot(), path)
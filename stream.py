@@ -1,31 +1,62 @@
 import argparse
 import cv2
+import itertools
 import threading
 import time
 
-import numpy as np
-
+import clock
+import tiling
+from async_host import AsyncHost, BlockingHost
+from codec import CODECS, AdaptiveCodecController, EncodePool, make_codec
+from dispatcher import AsyncDispatcher, Dispatcher
+from gate import MotionGate
+from histogram import Histogram, format_snapshot, write_snapshot
 from host import Host
+from reorder import ReorderBuffer
+from result_cache import CACHE_MODES, ResultCache
+from scheduler import SCHEDULERS, make_scheduler
+from tracker import BoxTracker
 import di_utils
 
 DEVICE_NAME_MAP = ["EdgeTPU", "Jetson", "UP Squared"]
 
+# Result of a frame held back by the motion gate, which reuses the detections of the frames before it
+REUSED = object()
+# Result of a frame between keyframes, whose boxes are tracked from the last keyframe
+TRACKED = object()
+
 
 class StreamMeasurement:
     MODE_SEND, MODE_GET = 0, 1
 
-    def __init__(self, name_map, report_interval=10):
+    def __init__(self, name_map, report_interval=10, alpha=0.2, window=None):
 
         self.report_interval = report_interval
         self.name_map = name_map
+        self.alpha = alpha
 
         self.start_times = [0.] * len(name_map)
         self.send_times = [0.] * len(name_map)
         self.get_times = [0.] * len(name_map)
         self.send_recents = [0.] * len(name_map)
         self.get_recents = [0.] * len(name_map)
+        self.send_ewma = [0.] * len(name_map)
+        self.get_ewma = [0.] * len(name_map)
         self.numread = [0] * len(name_map)
 
+        self.send_histograms = [Histogram(window) for _ in name_map]
+        self.get_histograms = [Histogram(window) for _ in name_map]
+        self.total_histograms = [Histogram(window) for _ in name_map]
+
+        # Where each frame's time went, from the timestamps reported by the relays
+        self.stage_histograms = [{stage: Histogram(window) for stage in clock.STAGES} for _ in name_map]
+        self.rtts = [0.] * len(name_map)
+        self.offsets = [0.] * len(name_map)
+
+        # Frames answered from the result cache, including frames that waited for an identical frame in flight
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         self.last_report = -1000
         self.start_time = time.time()
 
@@ -35,10 +66,18 @@ class StreamMeasurement:
             raise ValueError("StreamMeasurement: Requested {} out of {} devices"
                              .format(device_num, len(self.start_times)))
 
-        self.start_times[device_num] = time.time()
+        self.start_times[device_num] = time.perf_counter_ns()
 
     def stop(self, device_num, mode):
 
+        if device_num >= len(self.start_times):
+            raise ValueError("StreamMeasurement: Requested {} out of {} devices"
+                             .format(device_num, len(self.start_times)))
+
+        self.record(device_num, mode, (time.perf_counter_ns() - self.start_times[device_num]) / 1e9)
+
+    def record(self, device_num, mode, duration):
+
         if mode not in range(2):
             raise ValueError("StreamMeasurement: Bad mode")
 
@@ -48,22 +87,54 @@ class StreamMeasurement:
 
         if mode == StreamMeasurement.MODE_SEND:
 
-            self.send_recents[device_num] = time.time() - self.start_times[device_num]
+            self.send_recents[device_num] = duration
 
             self.send_times[device_num] = \
                 self.send_times[device_num] + (self.send_recents[device_num] - self.send_times[device_num]) / (
                         self.numread[device_num] + 1)
+            self.send_ewma[device_num] = self._ewma(self.send_ewma[device_num], duration)
+            self.send_histograms[device_num].record_seconds(duration)
 
         elif mode == StreamMeasurement.MODE_GET:
 
-            self.get_recents[device_num] = time.time() - self.start_times[device_num]
+            self.get_recents[device_num] = duration
 
             self.get_times[device_num] = \
                 self.get_times[device_num] + (self.get_recents[device_num] - self.get_times[device_num]) / (
                         self.numread[device_num] + 1)
+            self.get_ewma[device_num] = self._ewma(self.get_ewma[device_num], duration)
+            self.get_histograms[device_num].record_seconds(duration)
+            # The send of a frame is always recorded just before its get
+            self.total_histograms[device_num].record_seconds(self.send_recents[device_num] + duration)
 
             self.numread[device_num] += 1
 
+    def record_breakdown(self, device_num, breakdown, rtt, offset):
+
+        if device_num >= len(self.start_times):
+            raise ValueError("StreamMeasurement: Requested {} out of {} devices"
+                             .format(device_num, len(self.start_times)))
+
+        for stage, duration in breakdown.items():
+            self.stage_histograms[device_num][stage].record_seconds(duration)
+        self.rtts[device_num] = rtt
+        self.offsets[device_num] = offset
+
+    def record_cache(self, hit):
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def cache_hit_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else 0.
+
+    def _ewma(self, average, sample):
+        if average == 0.:
+            return sample
+        return average + self.alpha * (sample - average)
+
     def report(self, force=False):
 
         if sum(self.numread) == 0:
@@ -79,6 +150,25 @@ class StreamMeasurement:
                             round(self.get_times[i] * 1000, 3), round(self.get_recents[i] * 1000, 3),
                             round((self.get_times[i] + self.send_times[i]) * 1000, 3),
                             round((self.get_recents[i] + self.send_recents[i]) * 1000, 3)))
+            print("Percentiles:")
+            for i, name in enumerate(self.name_map):
+                if self.numread[i] == 0:
+                    continue
+                print("{}: Send: {} | Get: {} | Total: {}".format(
+                    name, format_snapshot(self.send_histograms[i].snapshot()),
+                    format_snapshot(self.get_histograms[i].snapshot()),
+                    format_snapshot(self.total_histograms[i].snapshot())))
+            print("Breakdown (p50):")
+            for i, name in enumerate(self.name_map):
+                if self.stage_histograms[i]["infer"].count() == 0:
+                    continue
+                print("{}: {} | RTT: {}ms | Clock offset: {}ms".format(
+                    name, " | ".join(["{}: {}ms".format(stage.capitalize(), round(histogram.percentile(50) / 1e6, 3))
+                                      for stage, histogram in self.stage_histograms[i].items()]),
+                    round(self.rtts[i] * 1000, 3), round(self.offsets[i] * 1000, 3)))
+            if self.cache_hits + self.cache_misses:
+                print("Cache: {} hits, {} misses ({}% hit rate)".format(self.cache_hits, self.cache_misses,
+                                                                        round(self.cache_hit_rate() * 100, 1)))
             print("Current FPS:", sum(self.numread)/ (time.time() - self.start_time))
             print("Distribution:",
                   " ".join(["{}: {}%".format(self.name_map[i], round(self.numread[i] * 100 / sum(self.numread), 2))
@@ -88,137 +178,393 @@ class StreamMeasurement:
 
         return False
 
+    def snapshot(self):
+        return {name: {"send": self.send_histograms[i].snapshot(), "get": self.get_histograms[i].snapshot(),
+                       "total": self.total_histograms[i].snapshot(),
+                       "stages": {stage: histogram.snapshot() for stage, histogram in self.stage_histograms[i].items()},
+                       "rtt": self.rtts[i] * 1000, "offset": self.offsets[i] * 1000}
+                for i, name in enumerate(self.name_map)}
+
+    def export(self, path):
+        write_snapshot(self.snapshot(), path)
+
 
 class DistributedStream:
 
-    def __init__(self, port, labels, verbose=False):
+    def __init__(self, port, labels, verbose=False, window=2, use_async=False, scheduler="first",
+                 reorder_capacity=64, max_delay=None, codec="jpeg", quality=None, target_latency=None,
+                 encode_workers=0, num_connections=None, batch_size=1, batch_timeout=0.01, socket_options=None,
+                 motion_gate=None, keyframe_interval=1, tracker=None, tile_size=None, tile_overlap=0.2,
+                 nms_threshold=0.5, result_cache=None, histogram_window=None):
+
+        if keyframe_interval < 1:
+            raise ValueError("DistributedStream: Keyframe interval must be at least 1")
 
         self.labels = None
         if labels:
             self.labels = di_utils.read_labels(labels)
-        self.host = Host(port, verbose)
-        self.ready = [True] * len(self.host.conns)
-        self.labeled_frames = []
-        self.buffer_lock = threading.Lock()
-        self.final_frame = -1
+        self.renderer = di_utils.LabelRenderer(self.labels)
+        if use_async:
+            self.host = BlockingHost(AsyncHost(port, verbose, make_codec(codec, quality), num_connections,
+                                               socket_options))
+        else:
+            self.host = Host(port, verbose, make_codec(codec, quality), num_connections, socket_options)
+        num_devices = max(len(self.host.conns), len(DEVICE_NAME_MAP))
+        self.watch = StreamMeasurement([DEVICE_NAME_MAP[i] if i < len(DEVICE_NAME_MAP) else "Device {}".format(i)
+                                        for i in range(num_devices)], window=histogram_window)
+        self.scheduler = make_scheduler(scheduler, self.watch)
+        self.encode_pool = EncodePool(encode_workers) if encode_workers > 0 else None
+        if use_async:
+            # The connections are served by coroutines on the host's event loop rather than two threads each
+            self.dispatcher = AsyncDispatcher(self.host.host, self._on_result, window, self.scheduler, self._on_lost,
+                                              self.encode_pool, verbose, batch_size, batch_timeout)
+        else:
+            self.dispatcher = Dispatcher(self.host, self._on_result, window, self.scheduler, self._on_lost,
+                                         self.encode_pool, verbose, batch_size, batch_timeout)
+        self.codec_controller = None
+        if target_latency is not None:
+            self.codec_controller = AdaptiveCodecController(self.host, self.dispatcher.conns, self.watch,
+                                                            target_latency, verbose=verbose)
+        self.reorder = ReorderBuffer(reorder_capacity, max_delay)
+        self.motion_gate = motion_gate
+        self.keyframe_interval = keyframe_interval
+        self.tracker = tracker if tracker else (BoxTracker() if keyframe_interval > 1 else None)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.nms_threshold = nms_threshold
+        self.assembler = None
+        self.result_cache = result_cache
+        # Cache key of every frame in flight, and the frames waiting for the result of each key
+        self.cache_keys = {}
+        self.cache_waiting = {}
+        self.cache_lock = threading.Lock()
+        self.inferred = 0
+        self.stitched = 0
+        self.frames = {}
+        self.frames_lock = threading.Lock()
+        # Time from submitting each frame to writing it, kept as a histogram so long streams use fixed memory
+        self.latency_histogram = Histogram()
         self.w = -1
         self.h = -1
+        self.owns_frames = False
         self.verbose = verbose
-        self.watch = StreamMeasurement(DEVICE_NAME_MAP)
 
-    def _run_inference(self, conn, img, frame_num, idx):
+    def _on_result(self, idx, frame_num, result, send_time, get_time, timestamps=None):
 
-        self.watch.start(idx)
-        self.host.send_image(conn[0], img)
-        if self.verbose:
-            print("Sent frame: ", frame_num)
-        self.watch.stop(idx, StreamMeasurement.MODE_SEND)
+        self.watch.record(idx, StreamMeasurement.MODE_SEND, send_time)
+        self.watch.record(idx, StreamMeasurement.MODE_GET, get_time)
+        if timestamps is not None:
+            estimator = self.host.get_clock(self.dispatcher.conns[idx][0])
+            breakdown = estimator.breakdown(timestamps)
+            if breakdown is not None:
+                self.watch.record_breakdown(idx, breakdown, estimator.rtt / 1e9, estimator.offset / 1e9)
+        if self.codec_controller:
+            self.codec_controller.update(idx)
 
-        self.watch.start(idx)
-        result = self.host.get_infer_result(conn[0])
-        if result is None:
-            print("Connection {} broken".format(idx))
-            return
-        self.watch.stop(idx, StreamMeasurement.MODE_GET)
+        self._put_result(frame_num, result)
 
+    def _on_lost(self, idx, frame_num):
         if self.verbose:
-            print("Got infer result for frame ", frame_num)
-
-        labeled_img = np.copy(img)
+            print("Lost frame {} on connection {}".format(frame_num, idx))
+        if self.assembler:
+            self._put_result(frame_num, None)
+        else:
+            self._deliver(frame_num, None)
 
-        result = [((int(x1 * self.w / 300),
-                    int(y1 * self.h / 300),
-                    int(x2 * self.w / 300),
-                    int(y2 * self.h / 300), cls, conf)) for (x1, y1, x2, y2, cls, conf) in result]
+    def _put_result(self, frame_num, result):
 
-        if self.labels:
-            di_utils.draw_labels(labeled_img, result, labels=self.labels)
-        else:
-            di_utils.draw_labels(labeled_img, result)
+        if self.assembler is None:
+            self._deliver(frame_num, result)
+            return
 
-        with self.buffer_lock:
-            self.labeled_frames.append((frame_num, labeled_img))
-        self.ready[idx] = True
+        # In tiling mode, frame_num identifies a tile, and the frame is ready once all of its tiles are answered
+        res = self.assembler.put(frame_num, result)
+        if res is None:
+            return
+        self._deliver(*res)
+
+    def _deliver(self, frame_num, result):
+
+        # result is None for a lost frame, which is not cached, and is lost for the frames waiting on it as well
+        frame_nums = [frame_num]
+        if self.result_cache is not None:
+            with self.cache_lock:
+                key = self.cache_keys.pop(frame_num, None)
+                if key is not None:
+                    frame_nums += self.cache_waiting.pop(key, [])
+                    if result is not None:
+                        self.result_cache.put(key, result)
+
+        for num in frame_nums:
+            if result is None:
+                self.reorder.mark_lost(num)
+            else:
+                self.reorder.put(num, result)
+
+    def _cached(self, frame_num, frame):
+
+        # Returns True if the frame is answered from the cache, or by an identical frame that is already in flight
+        key = self.result_cache.key(frame)
+        with self.cache_lock:
+            waiting = self.cache_waiting.get(key)
+            if waiting is not None:
+                waiting.append(frame_num)
+                self.watch.record_cache(True)
+                return True
+
+            result = self.result_cache.get(key)
+            if result is not None:
+                self.reorder.put(frame_num, result)
+                self.watch.record_cache(True)
+                return True
+
+            self.cache_keys[frame_num] = key
+            self.cache_waiting[key] = []
+            self.watch.record_cache(False)
+            return False
 
-    def _stitch(self):
+    def _stitch(self, output):
 
-        done = False
-        current_frame = 0
-        vw = cv2.VideoWriter('out.avi', cv2.VideoWriter_fourcc(*'MJPG'), 20.0, (self.w, self.h))
+        vw = None
+        if output:
+            vw = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*'MJPG'), 20.0, (self.w, self.h))
 
-        while not done:
+        # Merged tile results are already in frame coordinates
+        scale = (1., 1.) if self.assembler else (self.w / 300, self.h / 300)
+        last_result = None
+        while True:
 
-            for frame in self.labeled_frames:
-                if frame[0] == current_frame:
-                    vw.write(frame[1])
-                    with self.buffer_lock:
-                        del frame
-                    current_frame += 1
-                    if self.verbose:
-                        print("Stitched frame ", current_frame - 1)
+            res = self.reorder.get()
+            if res is None:
+                break
 
-            if self.final_frame != -1:
-                if current_frame == self.final_frame:
-                    done = True
+            frame_num, result = res
+            with self.frames_lock:
+                img, frame, submit_time = self.frames.pop(frame_num)
 
-    def stream_video(self, input):
+            # Frames are stitched in order, so the frame a gated frame was compared with has already been stitched, and
+            # the tracker has seen every frame since the last keyframe
+            if result is REUSED:
+                result = last_result
+            else:
+                if self.tracker is not None:
+                    if result is TRACKED or result is None:
+                        # Lost frames are tracked as well, so their boxes are not missing from the video
+                        result = self.tracker.track(frame)
+                    else:
+                        self.tracker.reset(frame, result)
+                if result is not None:
+                    last_result = result
+
+            self.latency_histogram.record_seconds(time.time() - submit_time)
+            self.stitched += 1
+
+            if vw is None:
+                continue
+
+            if result is None:
+                # Skipped frames are written without labels to keep the video timing
+                vw.write(img)
+                if self.verbose:
+                    print("Skipped frame ", frame_num)
+                continue
+
+            # Frames read from a video belong to the stream, so they are labeled without a copy
+            labeled_img = self.renderer.draw(img, result, *scale, in_place=self.owns_frames)
+
+            vw.write(labeled_img)
+            if self.verbose:
+                print("Stitched frame ", frame_num)
+
+        if vw is not None:
+            vw.release()
+
+    def _report_components(self):
+        self.dispatcher.report(self.watch.name_map)
+        if self.codec_controller:
+            self.codec_controller.report(self.watch.name_map)
+        if self.motion_gate:
+            self.motion_gate.report()
+        if self.result_cache is not None:
+            self.result_cache.report()
+        if self.tracker:
+            elapsed = max(time.time() - self.watch.start_time, 1e-9)
+            print("Keyframes: output {} FPS, inferred {} FPS".format(round(self.stitched / elapsed, 3),
+                                                                    round(self.inferred / elapsed, 3)))
+
+    def _read_video(self, input):
 
         vcap = cv2.VideoCapture(input)
         self.w = int(vcap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.h = int(vcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-        stitch_thread = threading.Thread(target=self._stitch)
-        stitch_thread.start()
-
-        frame_num = 0
-        self.watch.start_time = time.time()
-
         while vcap.isOpened():
-
             ret, img = vcap.read()
-
             if not ret:
                 break
+            yield img
 
-            if (self.w, self.h) != (300, 300):
-                frame = cv2.resize(img, (300, 300))
-            else:
-                frame = img
-
-            sent = False
-
-            while not sent:
+        vcap.release()
 
-                for idx, conn in enumerate(self.host.get_connections()):
+    def stream_video(self, input, output="out.avi"):
 
-                    if not self.ready[idx]:
-                        continue
-
-                    self.ready[idx] = False
-                    t = threading.Thread(target=self._run_inference, args=(conn, frame, frame_num, idx))
-                    t.start()
-                    sent = True
-                    break
+        self.owns_frames = isinstance(input, str)
+        if self.owns_frames:
+            frames = self._read_video(input)
+            # Reads the first frame, which sets the video size
+            first = next(frames, None)
+        else:
+            frames = iter(input)
+            first = next(frames, None)
+            if first is not None:
+                self.h, self.w = first.shape[:2]
+
+        if first is not None:
+            frames = itertools.chain([first], frames)
+
+        if self.motion_gate:
+            self.motion_gate.reset()
+        self.inferred = 0
+        self.stitched = 0
+        last_keyframe = None
+        self.assembler = None
+        self.cache_keys.clear()
+        self.cache_waiting.clear()
+        if self.tile_size:
+            self.assembler = tiling.TileAssembler(tiling.tile_grid(self.w, self.h, self.tile_size, self.tile_overlap),
+                                                  self.nms_threshold)
+
+        stitch_thread = threading.Thread(target=self._stitch, args=(output,))
+        stitch_thread.start()
 
-            frame_num += 1
+        self.dispatcher.start()
 
-            self.watch.report()
+        frame_num = 0
+        self.watch.start_time = time.time()
+        start_cpu = time.process_time()
+
+        try:
+            for img in frames:
+
+                if (self.w, self.h) != (300, 300) and not self.assembler:
+                    frame = cv2.resize(img, (300, 300))
+                else:
+                    # Tiles are cut from the full frame, so the gate and the tracker work on it as well
+                    frame = img
+
+                self.reorder.reserve(frame_num)
+                with self.frames_lock:
+                    self.frames[frame_num] = (img, frame, time.time())
+                if self.tracker and last_keyframe is not None and frame_num - last_keyframe < self.keyframe_interval \
+                        and not self.tracker.needs_keyframe:
+                    self.reorder.put(frame_num, TRACKED)
+                elif self.motion_gate and not self.motion_gate.check(frame):
+                    self.reorder.put(frame_num, REUSED)
+                else:
+                    if self.tracker:
+                        # Cleared here rather than when the keyframe is stitched, which happens a few frames later
+                        self.tracker.needs_keyframe = False
+                    last_keyframe = frame_num
+                    if self.result_cache is None or not self._cached(frame_num, frame):
+                        self.inferred += 1
+                        if self.assembler:
+                            for tile, crop in enumerate(tiling.crop_tiles(img, self.assembler.tiles)):
+                                self.dispatcher.submit(self.assembler.tile_id(frame_num, tile), crop)
+                        else:
+                            self.dispatcher.submit(frame_num, frame)
+
+                frame_num += 1
+
+                if self.watch.report():
+                    self._report_components()
+        finally:
+            self.reorder.finish(frame_num)
+            stitch_thread.join()
+            self.dispatcher.close()
+            if self.encode_pool:
+                self.encode_pool.close()
+
+        duration = time.time() - self.watch.start_time
+        cpu_time = time.process_time() - start_cpu
 
         self.watch.report(force=True)
+        self._report_components()
+        print("Scheduler {}: {} frames at {} FPS, {} inferred at {} FPS, {} skipped".format(
+            self.scheduler.name, frame_num, round(frame_num / duration, 3), self.inferred,
+            round(self.inferred / duration, 3), self.reorder.skipped))
+
+        return {"frames": frame_num, "duration": duration, "fps": frame_num / duration if duration > 0 else 0.,
+                "skipped": self.reorder.skipped, "gated": self.motion_gate.gated if self.motion_gate else 0,
+                "inferred": self.inferred, "inferred_fps": self.inferred / duration if duration > 0 else 0.,
+                "cache_hits": self.watch.cache_hits, "cache_hit_rate": self.watch.cache_hit_rate(),
+                "cpu_time": cpu_time, "latency": self.latency_histogram.snapshot((50, 95, 99))}
 
-        self.final_frame = frame_num - 1
+    def close(self):
+        self.host.close()
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", "-i", help="File path to input image", required=True)
+    parser.add_argument("--input", "-i", help="File path to input video", required=True)
+    parser.add_argument("--output", "-o", help="File path of the labeled output video", default="out.avi")
     parser.add_argument("--port", "-p", help="Listening port to use", default=8080, type=int)
     parser.add_argument("--labels", "-l", help="Path of labels file")
     parser.add_argument("--verbose", "-v", help="Enables verbose logging", action='store_true')
+    parser.add_argument("--window", "-w", help="Number of frames in flight on each device", default=2, type=int)
+    parser.add_argument("--async", dest="use_async", help="Serve the connections from an asyncio event loop",
+                        action="store_true")
+    parser.add_argument("--scheduler", "-s", help="Device scheduling policy", default="first", choices=SCHEDULERS)
+    parser.add_argument("--reorder_capacity", help="Maximum number of frames waiting to be written", default=64,
+                        type=int)
+    parser.add_argument("--max_delay", help="Seconds a frame may be late before it is written without labels",
+                        type=float)
+    parser.add_argument("--codec", "-c", help="Image codec", default="jpeg", choices=list(CODECS))
+    parser.add_argument("--quality", "-q", help="Codec quality (compression level for png)", type=int)
+    parser.add_argument("--target_latency", help="Adapt each device's codec quality to keep its send time near this "
+                                                 "many milliseconds", type=float)
+    parser.add_argument("--encode_workers", help="Number of processes that encode frames off the dispatch path",
+                        default=0, type=int)
+    parser.add_argument("--num_connections", "-n", help="Wait for this many clients instead of asking", type=int)
+    parser.add_argument("--batch_size", "-b", help="Maximum number of frames sent to a device in one message",
+                        default=1, type=int)
+    parser.add_argument("--batch_timeout", help="Seconds to wait for a batch to fill", default=0.01, type=float)
+    parser.add_argument("--send_buffer", help="Socket send buffer size in bytes", type=int)
+    parser.add_argument("--receive_buffer", help="Socket receive buffer size in bytes", type=int)
+    parser.add_argument("--gate", help="Reuse the previous detections for frames without motion", action="store_true")
+    parser.add_argument("--keyframe_interval", "-k", help="Infer every k-th frame and track boxes in between",
+                        default=1, type=int)
+    parser.add_argument("--tile_size", "-t", help="Infer frames as overlapping tiles of this size", type=int)
+    parser.add_argument("--tile_overlap", help="Overlap between tiles, as a fraction of the tile size", default=0.2,
+                        type=float)
+    parser.add_argument("--nms_threshold", help="IoU above which overlapping tile boxes are merged", default=0.5,
+                        type=float)
+    parser.add_argument("--cache", help="Answer repeated frames from a result cache with exact or perceptual keys",
+                        choices=CACHE_MODES)
+    parser.add_argument("--histogram_window", help="Only report latency percentiles over roughly the last this many "
+                                                   "seconds", type=float)
+    parser.add_argument("--histogram_output", help="Write the final latency percentiles of every device to this JSON "
+                                                   "file")
     args = parser.parse_args()
 
-    stream = DistributedStream(args.port, args.labels, args.verbose)
-    stream.stream_video(args.input)
+    stream = DistributedStream(args.port, args.labels, args.verbose, args.window, args.use_async, args.scheduler,
+                               reorder_capacity=args.reorder_capacity, max_delay=args.max_delay, codec=args.codec,
+                               quality=args.quality,
+                               target_latency=args.target_latency / 1000 if args.target_latency is not None else None,
+                               encode_workers=args.encode_workers, num_connections=args.num_connections,
+                               batch_size=args.batch_size, batch_timeout=args.batch_timeout,
+                               socket_options=di_utils.socket_options(send_buffer=args.send_buffer,
+                                                                      receive_buffer=args.receive_buffer),
+                               motion_gate=MotionGate() if args.gate else None,
+                               keyframe_interval=args.keyframe_interval, tile_size=args.tile_size,
+                               tile_overlap=args.tile_overlap, nms_threshold=args.nms_threshold,
+                               result_cache=ResultCache(args.cache) if args.cache else None,
+                               histogram_window=args.histogram_window)
+    try:
+        stream.stream_video(args.input, args.output)
+        if args.histogram_output:
+            stream.watch.export(args.histogram_output)
+    finally:
+        stream.close()
 
 
 if __name__ == '__main__':
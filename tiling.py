@@ -0,0 +1,117 @@
+import threading
+
+import cv2
+import numpy as np
+
+MODEL_SIZE = (300, 300)
+
+
+def tile_grid(width, height, tile_size=300, overlap=0.2):
+
+    # Returns (x, y, w, h) tiles of tile_size pixels that cover the frame, overlapping by at least overlap of a tile
+    if tile_size < 1:
+        raise ValueError("tiling: Tile size must be at least 1")
+    if not 0 <= overlap < 1:
+        raise ValueError("tiling: Overlap must be at least 0 and less than 1")
+
+    def starts(length):
+        size = min(tile_size, length)
+        if length <= size:
+            return [0], size
+        count = int(np.ceil((length - size) / (size * (1 - overlap)))) + 1
+        return np.linspace(0, length - size, count).round().astype(int).tolist(), size
+
+    xs, tile_w = starts(width)
+    ys, tile_h = starts(height)
+    return [(x, y, tile_w, tile_h) for y in ys for x in xs]
+
+
+def crop_tiles(img, tiles, model_size=MODEL_SIZE):
+    crops = []
+    for x, y, w, h in tiles:
+        crop = img[y:y + h, x:x + w]
+        crops.append(np.ascontiguousarray(crop) if (w, h) == model_size else cv2.resize(crop, model_size))
+    return crops
+
+
+def to_frame(results, tile, model_size=MODEL_SIZE):
+
+    # Maps a protocol.RESULT_DTYPE array from the model input of a tile to frame coordinates
+    x, y, w, h = tile
+    scale_x, scale_y = w / model_size[0], h / model_size[1]
+    mapped = results.copy()
+    mapped["x1"] = np.rint(results["x1"] * scale_x + x)
+    mapped["y1"] = np.rint(results["y1"] * scale_y + y)
+    mapped["x2"] = np.rint(results["x2"] * scale_x + x)
+    mapped["y2"] = np.rint(results["y2"] * scale_y + y)
+    return mapped
+
+
+def nms(results, iou_threshold=0.5, class_aware=True):
+
+    # Greedy non-maximum suppression over a RESULT_DTYPE array, with the IoU of every pair computed at once
+    if len(results) < 2:
+        return results
+
+    order = np.argsort(-results["conf"], kind="stable")
+    ranked = results[order]
+    boxes = np.stack([ranked["x1"], ranked["y1"], ranked["x2"], ranked["y2"]], axis=1).astype(np.float32)
+    areas = np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+    left = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    top = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    right = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    bottom = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    inter = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    iou = inter / np.maximum(areas[:, None] + areas[None, :] - inter, 1e-9)
+
+    # Each box can only be suppressed by a box with a higher confidence
+    suppresses = np.triu(iou > iou_threshold, k=1)
+    if class_aware:
+        suppresses &= ranked["cls"][:, None] == ranked["cls"][None, :]
+
+    keep = np.ones(len(ranked), dtype=bool)
+    for i in range(len(ranked)):
+        if keep[i]:
+            keep &= ~suppresses[i]
+    return ranked[keep]
+
+
+class TileAssembler:
+
+    def __init__(self, tiles, iou_threshold=0.5, model_size=MODEL_SIZE):
+
+        if not tiles:
+            raise ValueError("TileAssembler: At least one tile is required")
+
+        self.tiles = tiles
+        self.iou_threshold = iou_threshold
+        self.model_size = model_size
+        # Frame number -> [tile results in frame coordinates, tiles answered]
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def tile_id(self, frame_num, tile):
+        # Identifier of one tile of a frame, used as the frame id on the wire
+        return frame_num * len(self.tiles) + tile
+
+    def put(self, tile_id, result):
+
+        # result is None for a lost or dropped tile. Returns (frame_num, merged results) once every tile of the frame
+        # is answered, with None as the results if none of them was inferred, and None before that
+        frame_num, tile = divmod(tile_id, len(self.tiles))
+        if result is not None:
+            result = to_frame(result, self.tiles[tile], self.model_size)
+
+        with self.lock:
+            entry = self.pending.setdefault(frame_num, [[], 0])
+            if result is not None:
+                entry[0].append(result)
+            entry[1] += 1
+            if entry[1] < len(self.tiles):
+                return None
+            del self.pending[frame_num]
+
+        if not entry[0]:
+            return frame_num, None
+        return frame_num, nms(np.concatenate(entry[0]), self.iou_threshold)
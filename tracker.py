@@ -0,0 +1,126 @@
+import cv2
+import numpy as np
+
+
+class BoxTracker:
+
+    def __init__(self, max_points=400, min_points=3, grid=4, margin=0.1, min_alive=0.5, max_error=20.,
+                 max_scale_step=0.25):
+
+        if min_points < 1:
+            raise ValueError("BoxTracker: Minimum points must be at least 1")
+        if not 0 <= min_alive <= 1:
+            raise ValueError("BoxTracker: Minimum alive fraction must be between 0 and 1")
+
+        self.max_points = max_points
+        self.min_points = min_points
+        self.grid = grid
+        self.margin = margin
+        self.min_alive = min_alive
+        self.max_error = max_error
+        self.max_scale_step = max_scale_step
+        self.lk_params = dict(winSize=(15, 15), maxLevel=2,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+        self.gray = None
+        self.results = None
+        self.boxes = None
+        self.alive = None
+        # Tracked points, and the index of the box each one belongs to
+        self.points = None
+        self.owners = None
+        self.needs_keyframe = True
+        self.tracked = 0
+
+    @staticmethod
+    def _gray(frame):
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+    def _box_points(self, corners, box):
+
+        # Object outlines are often the only texture, so corners just outside the box count as well
+        x1, y1, x2, y2 = box
+        mx, my = (x2 - x1) * self.margin, (y2 - y1) * self.margin
+        inside = (corners[:, 0] >= x1 - mx) & (corners[:, 0] <= x2 + mx) & (corners[:, 1] >= y1 - my) & \
+            (corners[:, 1] <= y2 + my)
+        points = corners[inside]
+        if len(points) >= self.min_points:
+            return points
+
+        # Too little texture for corners, so a grid over the inside of the box is tracked as well
+        xs = np.linspace(x1, x2, self.grid + 2, dtype=np.float32)[1:-1]
+        ys = np.linspace(y1, y2, self.grid + 2, dtype=np.float32)[1:-1]
+        grid = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+        return np.concatenate([points, grid])
+
+    def reset(self, frame, results):
+
+        # Starts tracking the boxes of a keyframe; results is a protocol.RESULT_DTYPE array in frame coordinates
+        self.gray = BoxTracker._gray(frame)
+        self.results = results.copy()
+        self.boxes = np.stack([results["x1"], results["y1"], results["x2"], results["y2"]], axis=1).astype(np.float32)
+        self.alive = np.ones(len(results), dtype=bool)
+        self.needs_keyframe = False
+
+        corners = None
+        if len(results):
+            corners = cv2.goodFeaturesToTrack(self.gray, self.max_points, 0.01, 5)
+        corners = corners.reshape(-1, 2) if corners is not None else np.empty((0, 2), dtype=np.float32)
+
+        points = [self._box_points(corners, box) for box in self.boxes]
+        self.points = np.concatenate(points).astype(np.float32) if points else np.empty((0, 2), dtype=np.float32)
+        self.owners = np.concatenate([np.full(len(p), i) for i, p in enumerate(points)]) if points \
+            else np.empty(0, dtype=np.int64)
+
+    def _move(self, i, old, new):
+
+        # Shifts the box by the median motion of its points, and scales it by the median change of their spread
+        shift = np.median(new - old, axis=0)
+        old_spread = np.linalg.norm(old - np.median(old, axis=0), axis=1)
+        new_spread = np.linalg.norm(new - np.median(new, axis=0), axis=1)
+        valid = old_spread > 1
+        scale = 1.
+        if np.count_nonzero(valid) >= 2:
+            scale = float(np.clip(np.median(new_spread[valid] / old_spread[valid]), 1 - self.max_scale_step,
+                                  1 + self.max_scale_step))
+
+        x1, y1, x2, y2 = self.boxes[i]
+        cx, cy = (x1 + x2) / 2 + shift[0], (y1 + y2) / 2 + shift[1]
+        hw, hh = (x2 - x1) / 2 * scale, (y2 - y1) / 2 * scale
+        self.boxes[i] = (cx - hw, cy - hh, cx + hw, cy + hh)
+
+    def track(self, frame):
+
+        # Returns the boxes of the last keyframe moved to this frame, or None if there has not been a keyframe yet
+        if self.gray is None:
+            return None
+
+        gray = BoxTracker._gray(frame)
+        if len(self.points):
+            new, status, error = cv2.calcOpticalFlowPyrLK(self.gray, gray, self.points.reshape(-1, 1, 2), None,
+                                                          **self.lk_params)
+            new = new.reshape(-1, 2)
+            ok = (status.ravel() == 1) & (error.ravel() < self.max_error)
+
+            for i in np.flatnonzero(self.alive):
+                selected = ok & (self.owners == i)
+                if np.count_nonzero(selected) < self.min_points:
+                    self.alive[i] = False
+                    continue
+                self._move(i, self.points[selected], new[selected])
+
+            self.points = new[ok]
+            self.owners = self.owners[ok]
+
+        self.gray = gray
+        self.tracked += 1
+
+        if np.count_nonzero(self.alive) < self.min_alive * len(self.alive):
+            # Most objects were lost, so the next frame should be inferred
+            self.needs_keyframe = True
+
+        h, w = gray.shape[:2]
+        boxes = np.clip(np.rint(self.boxes[self.alive]), 0, [w - 1, h - 1, w - 1, h - 1])
+        results = self.results[self.alive].copy()
+        results["x1"], results["y1"], results["x2"], results["y2"] = boxes.T
+        return results